@@ -0,0 +1,81 @@
+"""
+# File Name: access_map.py
+#
+# Description: Implemented Data Model Access Map Generator
+#
+# Functionality:
+#  - Generates the flat (generic parameter path -> access) map that the Database classes
+#    load as their Implemented Data Model (e.g. erdk-dm.json, test-dm.json) from the full
+#    data model (the TR-181 XML or its xml2json conversion, see dm.DataModel)
+#  - Optionally restricted to the parameters within a set of subtrees
+#  - Written either as JSON (one parameter per line, sorted by path) or as a sorted access map
+#    (tab-separated path and access per line, sorted by path) that path_index.SortedAccessMap
+#    searches in place instead of loading it
+#
+#   Function: generate(data_model, subtrees=None)
+#   Function: write_json(access_map, out_file)
+#   Function: write_sorted(access_map, out_file)
+#
+# Usage: python access_map.py [--subtree PATH ...] [--format json|sorted] [--output DM_FILE] MODEL_FILE
+#
+"""
+
+import sys
+import json
+import argparse
+
+import dm
+
+
+def generate(data_model, subtrees=None):
+    """Retrieve the (generic parameter path -> access) of the model's parameters, sorted by path
+
+    subtrees restricts the map to the parameters whose path starts with one of them
+    """
+    access_map = {}
+    subtrees = tuple(subtrees) if subtrees else None
+
+    for path, access in data_model.iter_param_access():
+        if subtrees is None or path.startswith(subtrees):
+            access_map[path] = access
+
+    # Sorted bytewise, the order that path_index.SortedAccessMap searches in
+    return {path: access_map[path] for path in sorted(access_map, key=str.encode)}
+
+
+def write_json(access_map, out_file):
+    """Write the access map as JSON, one parameter per line"""
+    json.dump(access_map, out_file, indent="\t")
+    out_file.write("\n")
+
+
+def write_sorted(access_map, out_file):
+    """Write the access map as tab-separated (path, access) lines, sorted by path"""
+    for path in sorted(access_map, key=str.encode):
+        out_file.write("{}\t{}\n".format(path, access_map[path]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate an Implemented Data Model access map from the full data model")
+    parser.add_argument("model_file", help="TR-181 XML, or its xml2json --strip_text --strip_namespace conversion")
+    parser.add_argument("--subtree", action="append", default=None,
+                        help="only include the parameters within this generic path (repeatable)")
+    parser.add_argument("--format", choices=("json", "sorted"), default="json",
+                        help="JSON, or a sorted access map (use a .tsv file name for the Database classes)")
+    parser.add_argument("--output", default=None, help="file to write (default: stdout)")
+    args = parser.parse_args()
+
+    access_map = generate(dm.DataModel(args.model_file), args.subtree)
+    write = write_json if args.format == "json" else write_sorted
+
+    if args.output is None:
+        write(access_map, sys.stdout)
+    else:
+        with open(args.output, "w") as out_file:
+            write(access_map, out_file)
+
+    sys.stderr.write("{} parameters\n".format(len(access_map)))
+
+
+if __name__ == "__main__":
+    main()
@@ -27,30 +27,38 @@ SOFTWARE.
 #  - Dictionary as a database (key=full parameter path, value=parameter value)
 #  - The database is initialized from a JSON formatted file
 #  - Get command for full parameter path
+#  - Get Many command for a set of full and partial parameter paths (evaluates dynamic values once)
 #  - Update command for full parameter path
 #  - Insert command for tables
 #  - Delete command for tables
 #  - Find commands for wild-carded or partial parameter paths (returns full parameter paths)
 #  --- find_params: find parameter paths
 #  --- find_instances: find multi-object instance partial paths
+#  --- iter_instances / iter_objects: lazy variants of find_instances / find_objects
 #  --- find_impl_objects: find implemented object partial paths
-#  - Save command (saves the contents of the database back to a file)
+#  - Save command (commits the changes to the database's change log, see change_log.py)
+#  - Transactions (begin/commit/rollback) so that a set of changes is saved or undone as a unit
 #
 """
 
 
 import re
-import json
 import time
 import logging
 import datetime
 import threading
-import prometheus_client
 
 import pprint
 
+import prometheus_client
+
 import utils
+import path_index
+import change_log
+import metrics
 
+# Deprecated: superseded by the database_processing_seconds histogram (see metrics.py), which has
+# database/operation labels and buckets. Kept for existing dashboards and alerts until they've moved over.
 # pylint: disable-msg=no-value-for-parameter
 DB_GET_SUMMARY_METRIC = \
     prometheus_client.Summary("database_get_processing_seconds",
@@ -85,14 +93,23 @@ DB_FIND_IMPL_OBJECTS_SUMMARY_METRIC = \
                               "Time spent handling Database FindImplObjects Call")
 
 
+# Parameter values that are computed when they are retrieved
+DYNAMIC_VALUES = ("__UPTIME__", "__IPADDR__", "__CURR_TIME__", "__NUM_ENTRIES__")
+
+# Marks a path that wasn't in the DB when its change was recorded in the undo log
+_NOT_IN_DB = object()
+
+
 class Database:
     """Represents a simple database"""
     def __init__(self, dm_filename, db_filename, net_intf, debug=False):
         """Initialize the DB from a file"""
         self._net_intf = net_intf
         self._db_filename = db_filename
-        self._file_write_lock = threading.Lock()
-        self._new_inst_num_lock = threading.Lock()
+        self._change_log = change_log.ChangeLog(db_filename)
+        self._transaction_lock = threading.RLock()
+        self._undo_log = None
+        self._savepoint = None
         self._start_time = time.time()
 
         self._supported_insert_path_list = [
@@ -109,43 +126,25 @@ class Database:
         self._log = logging.getLogger(self.__class__.__name__)
         self._log.debug("Initializing the Database...")
 
-        # Retrieve the Implemented Data Model
-        with open(dm_filename, "r") as dm_in_json:
-            try:
-                self._dm = json.load(dm_in_json)
-            except ValueError as parse_err:
-                self._dm = {}
-                self._log.error("Implemented Data Model is NOT properly formatted JSON: %s", parse_err)
+        # Retrieve the Implemented Data Model, and index it so that validating a path is a lookup, not a scan
+        try:
+            self._dm, self._schema = path_index.load_dm(dm_filename)
+        except ValueError as parse_err:
+            self._dm = {}
+            self._schema = path_index.SchemaIndex(self._dm)
+            self._log.error("Implemented Data Model is NOT properly formatted JSON: %s", parse_err)
 
         #Load DB
         self.reset()
 
     @DB_GET_SUMMARY_METRIC.time()
+    @metrics.instrument("agent_db", "get")
     def get(self, path):
         """Retrieve the value of the incoming path, or throw a NoSuchPathError"""
         value = None
 
         if path in self._db:
-            if self._db[path] == "__UPTIME__":
-                value = int(time.time() - self._start_time)
-            elif self._db[path] == "__IPADDR__":
-                value = utils.IPAddr.get_ip_addr(self._net_intf)
-            elif self._db[path] == "__CURR_TIME__":
-                time_zone = self._db["Device.Time.LocalTimeZone"]
-                tz_part = time_zone.split(",")[0]
-                now = datetime.datetime.now()
-                now_str = now.strftime("%Y-%m-%dT%H:%M:%S")
-                if tz_part == "CST6CDT":
-                    now_str += "-06:00"
-                else:
-                    now_str += "Z"
-                value = now_str
-            elif self._db[path] == "__NUM_ENTRIES__":
-                inst_path = re.sub(r'NumberOfEntries', '.', path)
-                found_instances = self.find_instances(inst_path)
-                value = len(found_instances)
-            else:
-                value = self._db[path]
+            value = self._get_value(path, {})
         elif path.endswith('.'):
             value = self.get_obj(path)
         else:
@@ -155,22 +154,111 @@ class Database:
 
     def get_obj(self, partial_path):
         results = {}
+        dynamic_values = {}
         items = self.find_params(partial_path)
         for item in items:
-            results[item] = self.get(item)
+            results[item] = self._get_value(item, dynamic_values)
         return results
 
+    @metrics.instrument("agent_db", "get_many", result_size=True)
+    def get_many(self, paths):
+        """Retrieve the values of the incoming paths (in the same shape as get), or throw a NoSuchPathError
+
+        Partial paths that fall inside of another requested partial path are served from the
+        enclosing path's results, and dynamic values are only computed once for the whole request
+        """
+        results = {}
+        dynamic_values = {}
+
+        # Sorting puts every partial path ahead of the partial paths inside of it
+        for path in sorted(set(paths)):
+            if path in self._db:
+                results[path] = self._get_value(path, dynamic_values)
+            elif path.endswith('.'):
+                enclosing_path = self._find_enclosing_path(path, results)
+                if enclosing_path is None:
+                    items = self.find_params(path)
+                    results[path] = {item: self._get_value(item, dynamic_values) for item in items}
+                elif self._schema.is_object(self._generic_dm_path(path)):
+                    results[path] = {item: value for item, value in results[enclosing_path].items()
+                                     if item.startswith(path)}
+                else:
+                    raise NoSuchPathError(path)
+            else:
+                raise NoSuchPathError(path)
+
+        return {path: results[path] for path in paths}
+
+    def _find_enclosing_path(self, partial_path, results):
+        """Retrieve an already resolved partial path that contains the incoming one, or None"""
+        if "*" in partial_path:
+            return None
+
+        end = partial_path.rfind(".", 0, len(partial_path) - 1)
+        while end > 0:
+            enclosing_path = partial_path[:end + 1]
+            if enclosing_path in results and "*" not in enclosing_path:
+                return enclosing_path
+            end = partial_path.rfind(".", 0, end)
+
+        return None
+
+    def _get_value(self, path, dynamic_values):
+        """Retrieve the value of a path in the DB, computing dynamic values once per dynamic_values dict"""
+        value = self._db[path]
+
+        if value in DYNAMIC_VALUES:
+            # Number of Entries depends on the path, the other dynamic values don't
+            dynamic_key = path if value == "__NUM_ENTRIES__" else value
+            if dynamic_key not in dynamic_values:
+                dynamic_values[dynamic_key] = self._get_dynamic_value(path, value)
+            value = dynamic_values[dynamic_key]
+
+        return value
+
+    def _get_dynamic_value(self, path, dynamic_value):
+        """Compute the current value of a dynamic parameter"""
+        value = None
+
+        if dynamic_value == "__UPTIME__":
+            value = int(time.time() - self._start_time)
+        elif dynamic_value == "__IPADDR__":
+            value = utils.IPAddr.get_ip_addr(self._net_intf)
+        elif dynamic_value == "__CURR_TIME__":
+            time_zone = self._db["Device.Time.LocalTimeZone"]
+            tz_part = time_zone.split(",")[0]
+            now = datetime.datetime.now()
+            now_str = now.strftime("%Y-%m-%dT%H:%M:%S")
+            if tz_part == "CST6CDT":
+                now_str += "-06:00"
+            else:
+                now_str += "Z"
+            value = now_str
+        elif dynamic_value == "__NUM_ENTRIES__":
+            inst_path = re.sub(r'NumberOfEntries', '.', path)
+            if not self._schema.is_table(self._generic_dm_path(inst_path)):
+                raise NoSuchPathError(inst_path)
+            value = self._instance_index.get_count(inst_path)
+
+        return value
+
     def _update(self, path, value):
         dm_param_path = self._generic_dm_path(path)
 
         # Validate that path is in the Implemented Data Model
-        if dm_param_path in self._dm:
-            self._db[path] = value
-            #self._save()
+        if self._schema.is_param(dm_param_path):
+            # Waits for another thread's transaction to end
+            with self._transaction_lock:
+                self._record_undo(path)
+                self._db[path] = value
+                self._index_path(path)
+                self._change_log.record_set(path, value)
+                #self._save()
         else:
             raise NoSuchPathError(path)
 
     @DB_UPDATE_SUMMARY_METRIC.time()
+    @metrics.instrument("agent_db", "update")
     def update(self, path, value):
         """Change the value of the incoming path, or throw a NoSuchPathError"""
         if self.is_param_writable(path):
@@ -179,37 +267,33 @@ class Database:
             raise NoSuchPathError(path)
 
     @DB_FIND_PARAMS_SUMMARY_METRIC.time()
+    @metrics.instrument("agent_db", "find_params", result_size=True)
     def find_params(self, path):
         """Retrieve a set of parameter paths that match the incoming path"""
         found_keys = []
-        is_implemented_path = False
-
-        # Turn the incoming path into a regex to validate it is in the implemented data model
-        dm_regex_str = self._dm_regex(path, path.endswith("."))
-        self._log.debug("find_params: Using regex \"%s\" to validate Path [%s] is in the Implemented Data Model",
-                     dm_regex_str, path)
-
-        # Turn the incoming path into a regex to get the matching paths
-        db_regex_str = self._db_regex(path, path.endswith("."))
-        self._log.debug("find_params: Using regex \"%s\" to retrieve values from the Database for Path [%s]",
-                     db_regex_str, path)
+        partial_path = path.endswith(".")
+        path_parts = path_index.PathTrie.split_path(path)
 
         # Validate that path is in the Implemented Data Model
-        dm_keys = self._dm.keys()
-        for dm_key in dm_keys:
-            if re.fullmatch(dm_regex_str, dm_key) is not None:
-                is_implemented_path = True
-                break
+        dm_path = self._generic_dm_path(path)
+        self._log.debug("find_params: Using \"%s\" to validate Path [%s] is in the Implemented Data Model",
+                     dm_path, path)
+
+        if partial_path:
+            is_implemented_path = self._schema.is_object(dm_path)
+        else:
+            is_implemented_path = self._schema.is_param(dm_path)
 
         # If the path is Valid then retrieve the matching paths
         if is_implemented_path:
-            for param_path in self._db:
-                if re.fullmatch(db_regex_str, param_path) is not None:
-                    path_parts = param_path.split(".")
-                    path_part_len = len(path_parts) - 1
-
-                    if not self._is_meta_parameter(path_parts, path_part_len):
-                        found_keys.append(param_path)
+            for prefix, node in self._db_index.match(path_parts):
+                if partial_path:
+                    for param_path in path_index.PathTrie.iter_paths(node, prefix):
+                        param_path_parts = param_path.split(".")
+                        if not self._is_meta_parameter(param_path_parts, len(param_path_parts) - 1):
+                            found_keys.append(param_path)
+                elif node.is_path:
+                    found_keys.append(prefix[:-1])
         else:
             raise NoSuchPathError(path)
 
@@ -224,8 +308,8 @@ class Database:
         dm_param_path = self._generic_dm_path(param_path)
 
         # Validate that path is in the Implemented Data Model
-        if dm_param_path in self._dm:
-            if self._dm[dm_param_path] == "readWrite":
+        if self._schema.is_param(dm_param_path):
+            if self._schema.get_access(dm_param_path) == "readWrite":
                 is_writable = True
         else:
             raise NoSuchPathError(dm_param_path)
@@ -233,158 +317,85 @@ class Database:
         return is_writable
 
     @DB_FIND_INSTANCES_SUMMARY_METRIC.time()
+    @metrics.instrument("agent_db", "find_instances", result_size=True)
     def find_instances(self, partial_path):
         """Retrieve a set of object instance paths that match the incoming path"""
-        found_keys = []
-        is_implemented_path = False
+        return list(self.iter_instances(partial_path))
 
-        if partial_path.endswith("."):
-            # Turn the incoming path into a regex to validate it is in the implemented data model
-            dm_regex_str = self._dm_regex(partial_path, True)
-            self._log.debug("find_instances: Using regex \"%s\" to validate Path [%s] is in the Implemented Data Model",
-                         dm_regex_str, partial_path)
+    def iter_instances(self, partial_path):
+        """Retrieve an iterator over the object instance paths that match the incoming path
 
-            # Turn the incoming path into a regex to get the matching paths
-            db_regex_str = self._db_regex(partial_path, True)
-            self._log.debug("find_instances: Using regex \"%s\" to retrieve values from the Database for Path [%s]",
-                         db_regex_str, partial_path)
-        else:
+        The path is validated straight away, the matching paths are found as the iterator is consumed
+        """
+        if not partial_path.endswith("."):
             raise NoSuchPathError(partial_path)
 
-        # length minus 1 due to the ending "." causing 1 more split
-        partial_path_part_len = len(partial_path.split(".")) - 1
-
-        # Validate that path is in the Implemented Data Model
-        for dm_key in self._dm:
-            if re.fullmatch(dm_regex_str, dm_key) is not None:
-                # Validate that the partial_path is a multi-instance object
-                dm_key_parts = dm_key.split(".")
-                if dm_key_parts[partial_path_part_len] == "{i}":
-                    is_implemented_path = True
-                    break
-
-        # If the path is Valid then retrieve the matching paths
-        if is_implemented_path:
-            for path in self._db:
-                if re.fullmatch(db_regex_str, path) is not None:
-                    # We only want the path to the next level (instance identifiers)
-                    path_parts = path.split(".")
-                    built_path = utils.PathHelper.build_path_from_parts(path_parts, partial_path_part_len)
-                    found_key = built_path + path_parts[partial_path_part_len] + "."
-
-                    if not self._is_meta_parameter(path_parts, partial_path_part_len):
-                        # Only add it to found_keys if we haven't done so already
-                        if found_key not in found_keys:
-                            found_keys.append(found_key)
-        else:
+        # Validate that the partial_path is a multi-instance object in the Implemented Data Model
+        if not self._schema.is_table(self._generic_dm_path(partial_path)):
             raise NoSuchPathError(partial_path)
 
-        return found_keys
+        return self._iter_instances(partial_path)
+
+    def _iter_instances(self, partial_path):
+        """Yield the object instance paths that match the (validated) incoming path"""
+        for prefix, node in self._db_index.match(path_index.PathTrie.split_path(partial_path)):
+            # We only want the path to the next level (instance identifiers)
+            for inst_part in node.children:
+                if not self._is_meta_parameter([inst_part], 0):
+                    yield prefix + inst_part + "."
 
     @DB_FIND_OBJECTS_SUMMARY_METRIC.time()
+    @metrics.instrument("agent_db", "find_objects", result_size=True)
     def find_objects(self, partial_path):
         """Retrieve a set of instantiated object paths that match the incoming path"""
-        found_keys = []
-        is_implemented_path = False
+        return list(self.iter_objects(partial_path))
 
-        if partial_path.endswith("."):
-            # Turn the incoming path into a regex to validate it is in the implemented data model
-            dm_regex_str = self._dm_regex(partial_path, True)
-            self._log.debug("find_objects: Using regex \"%s\" to validate Path [%s] is in the Implemented Data Model",
-                         dm_regex_str, partial_path)
+    def iter_objects(self, partial_path):
+        """Retrieve an iterator over the instantiated object paths that match the incoming path
 
-            # Turn the incoming path into a regex to get the matching paths
-            db_regex_str = self._db_regex(partial_path, True)
-            self._log.debug("find_objects: Using regex \"%s\" to retrieve values from the Database for Path [%s]",
-                         db_regex_str, partial_path)
-        else:
+        The path is validated straight away, the matching paths are found as the iterator is consumed
+        """
+        if not partial_path.endswith("."):
             raise NoSuchPathError(partial_path)
 
-        # length minus 1 due to the ending "." causing 1 more split
-        partial_path_part_len = len(partial_path.split(".")) - 1
-
         # Validate that path is in the Implemented Data Model
-        for dm_key in self._dm:
-            if re.fullmatch(dm_regex_str, dm_key) is not None:
-                is_implemented_path = True
-                break
-
-        # If the path is Valid then retrieve the matching paths
-        if is_implemented_path:
-            for path in self._db:
-                if re.fullmatch(db_regex_str, path) is not None:
-                    # We only want the path to the next level (instance identifiers)
-                    path_parts = path.split(".")
-                    found_key = utils.PathHelper.build_path_from_parts(path_parts, partial_path_part_len)
-
-                    if found_key not in found_keys:
-                        found_keys.append(found_key)
-        else:
+        if not self._schema.is_object(self._generic_dm_path(partial_path)):
             raise NoSuchPathError(partial_path)
 
-        return found_keys
+        return self._iter_objects(partial_path)
+
+    def _iter_objects(self, partial_path):
+        """Yield the instantiated object paths that match the (validated) incoming path"""
+        for prefix, node in self._db_index.match(path_index.PathTrie.split_path(partial_path)):
+            if node.children:
+                yield prefix
 
     @DB_FIND_IMPL_OBJECTS_SUMMARY_METRIC.time()
+    @metrics.instrument("agent_db", "find_impl_objects", result_size=True)
     def find_impl_objects(self, partial_path, next_level):
         """Retrieve a set of implemented object paths that match the incoming path"""
-        found_keys = []
-        is_implemented_path = False
-        generic_partial_path = self._generic_dm_path(partial_path)
-
-        if partial_path.endswith("."):
-            # Turn the incoming path into a regex to validate it is in the implemented data model
-            dm_regex_str = self._dm_regex(partial_path, True)
-            self._log.debug(
-                "find_impl_objects: Using regex \"%s\" to validate Path [%s] is in the Implemented Data Model",
-                dm_regex_str, partial_path)
-        else:
+        if not partial_path.endswith("."):
             raise NoSuchPathError(partial_path)
 
-        # length minus 1 due to the ending "." causing 1 more split
-        partial_path_part_len = len(partial_path.split(".")) - 1
+        generic_partial_path = self._generic_dm_path(partial_path)
 
         # Validate that path is in the Implemented Data Model
-        for dm_key in self._dm:
-            if re.fullmatch(dm_regex_str, dm_key) is not None:
-                self._log.debug("find_impl_objects: Found full match: %s", dm_key)
-                found_key = None
-                key_parts = dm_key.split(".")
-                key_parts_len = len(key_parts)
-                is_implemented_path = True
-
-                if next_level:
-                    if key_parts_len > partial_path_part_len + 1:
-                        built_path = utils.PathHelper.build_path_from_parts(key_parts, partial_path_part_len)
-                        found_key = built_path + key_parts[partial_path_part_len] + "."
-                    else:
-                        print(key_parts)
-                        self._log.debug("find_impl_objects: key parts [%s] less than/equal partial path parts [%s]",
-                                     str(key_parts_len), str(partial_path_part_len + 1))
-                else:
-                    inx = 0
-                    found_key = ""
-                    while inx < (key_parts_len - 1):
-                        found_key += key_parts[inx]
-                        found_key += "."
-                        inx += 1
-
-                # Only add it to found_keys if we haven't done so already
-                if found_key is not None:
-                    self._log.debug("find_impl_objects: Found key: %s", found_key)
-                    if found_key not in found_keys:
-                        self._log.debug("find_impl_objects: Found key [%s] not already in the list", found_key)
-                        # Don't add the incoming partial_path
-                        if not found_key == generic_partial_path:
-                            self._log.debug("find_impl_objects: Adding found key [%s] to the list", found_key)
-                            found_keys.append(found_key)
-
-        # If the path is Valid then retrieve the matching paths
-        if not is_implemented_path:
+        if not self._schema.is_object(generic_partial_path):
             raise NoSuchPathError(partial_path)
 
+        if next_level:
+            # Only the objects directly below the partial path
+            found_keys = self._schema.get_child_objects(generic_partial_path)
+        else:
+            # The objects that contain the implemented parameters (other than the partial path itself)
+            found_keys = [found_key for found_key in self._schema.get_param_objects(generic_partial_path)
+                          if found_key != generic_partial_path]
+
+        self._log.debug("find_impl_objects: Found keys: %s", found_keys)
         return found_keys
 
     @DB_INSERT_SUMMARY_METRIC.time()
+    @metrics.instrument("agent_db", "insert")
     def insert(self, partial_path):
         """Insert a new record in the table"""
 
@@ -401,7 +412,8 @@ class Database:
                 #next_inst_num_path = partial_path + "__NextInstNum__"
                 next_inst_num_path = partial_path[:-1] + "NumberOfEntries"
                 print(next_inst_num_path)
-                with self._new_inst_num_lock:
+                # Instance numbers are handed out under the transaction lock, which _update takes anyway
+                with self._transaction_lock:
                     try:
                         next_inst_num = self.get(next_inst_num_path) + 1
                     except NoSuchPathError:
@@ -424,6 +436,7 @@ class Database:
         return next_inst_num
 
     @DB_DELETE_SUMMARY_METRIC.time()
+    @metrics.instrument("agent_db", "delete")
     def delete(self, partial_path):
         """Remove an existing record from the table"""
 
@@ -437,8 +450,12 @@ class Database:
 
             if dm_regex_str in self._supported_delete_path_list:
                 if dm_regex_str == "Device.Services.HomeAutomation.{i}.Camera.{i}.Pic.{i}.":
-                    del self._db[partial_path + "URL"]
-                    self._save()
+                    with self._transaction_lock:
+                        self._record_undo(partial_path + "URL")
+                        del self._db[partial_path + "URL"]
+                        self._unindex_path(partial_path + "URL")
+                        self._change_log.record_delete(partial_path + "URL")
+                        self._save()
                 else:
                     raise NotImplementedError()
             else:
@@ -446,56 +463,95 @@ class Database:
         else:
             raise NoSuchPathError(partial_path)
 
-    def _db_regex(self, path, partial_path):
-        """Generate a regex for determining whether or note a path is in the DB"""
-        db_regex_str = "^" + path
-        # Assuming that the internal storage is instance number based
-        db_regex_str = re.sub(r'\.\*\.', r'.[0-9]+.', db_regex_str)
-        db_regex_str = re.sub(r'\.', r'\.', db_regex_str)
+    def _generic_dm_path(self, path):
+        """Turn a DM Path into a Generic one by replacing instance numbers and wildcards"""
+        return utils.PathHelper.generic_dm_path(path)
 
-        if partial_path:
-            db_regex_str = db_regex_str + ".*"
+    def _is_meta_parameter(self, path_parts, partial_path_part_len):
+        """Determine if the parameter is a meta parameter"""
+        return path_parts[partial_path_part_len].startswith("__") and \
+               path_parts[partial_path_part_len].endswith("__")
 
-        return db_regex_str
+    def begin(self):
+        """Start a transaction, the changes made until commit() or rollback() are saved or undone together
 
-    def _dm_regex(self, path, partial_path):
-        """Generate a regex for determining whether or not a path is in the DM"""
-        dm_regex_str = "^" + path  # Starts with
-        dm_regex_str = re.sub(r'\.[0-9]+\.', r'.{i}.', dm_regex_str)  # Instance Number Addressing
-        dm_regex_str = re.sub(r'\.\*\.', r'.{i}.', dm_regex_str)  # Wild-card Searching
-        dm_regex_str = re.sub(r'\.', r'\.', dm_regex_str)  # Replace '.' with explicit '.' search
+        Other threads' changes wait until the transaction ends, transactions can't be nested
+        """
+        self._transaction_lock.acquire()
+        if self._undo_log is not None:
+            self._transaction_lock.release()
+            raise RuntimeError("A transaction is already in progress")
 
-        if partial_path:
-            dm_regex_str = dm_regex_str + ".*"
+        self._undo_log = []
+        self._savepoint = self._change_log.savepoint()
 
-        return dm_regex_str
+    def commit(self):
+        """Save the changes made in the transaction
 
-    def _generic_dm_path(self, path):
-        """Turn a DM Path into a Generic one by replacing instance numbers and wildcards"""
-        generic_path = re.sub(r'\.[0-9]+\.', r'.{i}.', path)  # Instance Number Addressing
-        generic_path = re.sub(r'\.\*\.', r'.{i}.', generic_path)  # Wild-card Searching
+        If the change log can't be written the transaction stays in progress and has to be rolled back
+        """
+        self._change_log.commit()
+        self._undo_log = None
+        self._transaction_lock.release()
 
-        return generic_path
+    def rollback(self):
+        """Undo the changes made in the transaction without reloading the persisted Database"""
+        try:
+            undo_log = self._undo_log
+            self._undo_log = None
+            for path, value in reversed(undo_log):
+                if value is _NOT_IN_DB:
+                    self._db.pop(path, None)
+                    self._unindex_path(path)
+                else:
+                    self._db[path] = value
+                    self._index_path(path)
+
+            # If the changes already reached the change log, record the undo as well
+            if not self._change_log.rollback_to(self._savepoint):
+                for path, value in undo_log:
+                    if path not in self._db:
+                        self._change_log.record_delete(path)
+                    else:
+                        self._change_log.record_set(path, self._db[path])
+        finally:
+            self._transaction_lock.release()
 
-    def _is_meta_parameter(self, path_parts, partial_path_part_len):
-        """Determine if the parameter is a meta parameter"""
-        return path_parts[partial_path_part_len].startswith("__") and \
-               path_parts[partial_path_part_len].endswith("__")
+    def _record_undo(self, path):
+        """Remember the current value of the path if there is an active transaction"""
+        if self._undo_log is not None:
+            self._undo_log.append((path, self._db.get(path, _NOT_IN_DB)))
 
     def _save(self):
-        """Save the contents of the DB back into the File"""
-        with self._file_write_lock:
-            with open(self._db_filename, "w") as db_file:
-                json.dump(self._db, db_file, indent=4)
+        """Save the changes made to the DB since the last save into the change log
+
+        Inside of a transaction the changes are saved when the transaction is committed
+        """
+        with self._transaction_lock:
+            if self._undo_log is None:
+                self._change_log.commit()
 
     def reset(self):
-        # Retrieve the Persisted Database
-        with open(self._db_filename, "r") as db_in_json:
-            try:
-                self._db = json.load(db_in_json)
-            except ValueError as parse_err:
-                self._db = {}
-                self._log.error("Persisted Database is NOT properly formatted JSON: %s", parse_err)
+        # Retrieve the Persisted Database (snapshot plus change log), dropping unsaved changes
+        try:
+            self._db = self._change_log.load()
+        except ValueError as parse_err:
+            self._db = {}
+            self._log.error("Persisted Database is NOT properly formatted JSON: %s", parse_err)
+
+        # Index the Database paths so that the find commands don't need to scan every key
+        self._db_index = path_index.PathTrie(self._db)
+        self._instance_index = path_index.InstanceIndex(self._db)
+
+    def _index_path(self, path):
+        """Add a path that has been set in the DB to the indexes"""
+        if self._db_index.add(path):
+            self._instance_index.add(path)
+
+    def _unindex_path(self, path):
+        """Remove a path that has been deleted from the DB from the indexes"""
+        if self._db_index.remove(path):
+            self._instance_index.remove(path)
 
 
 class NoSuchPathError(Exception):
@@ -517,33 +573,36 @@ class Agent(object):
 
     def Add(self, create_objs):
         created = {}
-        for obj in create_objs:
-            path = obj['path']
-            param_settings = obj['param_settings']
-            instance_num = self.db.insert(path)
-            for param_setting in param_settings:
-                self.db.update(path+str(instance_num)+'.'+param_setting['param'], param_setting['value'])
-            self.db._save()
-            created[obj['path']] = instance_num
+        self.db.begin()
+        try:
+            for obj in create_objs:
+                path = obj['path']
+                param_settings = obj['param_settings']
+                instance_num = self.db.insert(path)
+                for param_setting in param_settings:
+                    self.db.update(path+str(instance_num)+'.'+param_setting['param'], param_setting['value'])
+                created[obj['path']] = instance_num
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
         return created
 
     def Delete(self, paths):
         raise Exception("Delete is not implemented")
 
     def Set(self, objs):
+        self.db.begin()
         try:
             for obj in objs:
                 for param in obj['param_settings']:
                     self.db.update(obj['path']+param['param'], param['value'])
-            self.db._save()
+            self.db.commit()
         except:
-            self.db.reset()
+            self.db.rollback()
 
     def Get(self, paths):
-        result = {}
-        for path in paths:
-            result[path] = self.db.get(path)
-        return result
+        return self.db.get_many(paths)
 
     def GetInstances(self, path):
         return self.db.find_instances(path)
@@ -0,0 +1,65 @@
+"""
+# File Name: bench_xml2json.py
+#
+# Description: Benchmark of xml2json, building the whole tree vs --stream
+#
+# Functionality:
+#  - Runs xml2json -t xml2json --strip_text --strip_namespace on the XML file, with and without
+#    --stream, each one in its own process
+#  - Reports the best wall time and the peak RSS (from wait4) of each mode over the runs
+#  - Checks that both modes write the same JSON
+#
+# Usage: python bench_xml2json.py [--runs N] [XML_FILE]   (default: tr-181-2-12-0-usp-full.xml)
+#
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+
+XML2JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), "xml2json")
+MODES = (("tree", []), ("--stream", ["--stream"]))
+
+
+def run(xml_filename, out_filename, extra_args):
+    """Convert the XML file once, returning (wall seconds, peak RSS in MiB)"""
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, XML2JSON, "-t", "xml2json", "--strip_text", "--strip_namespace",
+                             "-o", out_filename, xml_filename] + extra_args)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError("xml2json {} failed".format(" ".join(extra_args)))
+
+    # ru_maxrss is in KiB on Linux
+    return elapsed, rusage.ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare xml2json with and without --stream")
+    parser.add_argument("xml_file", nargs="?", default="tr-181-2-12-0-usp-full.xml", help="XML file to convert")
+    parser.add_argument("--runs", type=int, default=3, help="runs of each mode, the best one is reported")
+    args = parser.parse_args()
+
+    outputs = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, extra_args in MODES:
+            out_filename = os.path.join(tmp_dir, name.strip("-") + ".json")
+            elapsed, peak_rss = min(run(args.xml_file, out_filename, extra_args) for _ in range(args.runs))
+            print("{:10s} {:.2f}s wall, {:.1f} MiB peak RSS".format(name + ":", elapsed, peak_rss))
+
+            with open(out_filename, "rb") as out_file:
+                outputs.append(out_file.read())
+
+    if any(output != outputs[0] for output in outputs):
+        sys.exit("The outputs differ")
+    print("Outputs are identical ({} bytes)".format(len(outputs[0])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+# File Name: change_log.py
+#
+# Description: Write-Ahead Change Log for the Agent Database
+#
+# Functionality:
+#  - The persisted database is a JSON snapshot file plus an append-only change log
+#    (one JSON [op, path, value] record per line) stored next to it
+#  - Changes are buffered in memory until commit(), which appends them with a single fsync
+#  - Once enough changes have been committed a background thread compacts the change log
+#    into a new snapshot file
+#  - load() reads the snapshot and replays the change log on top of it
+#
+#   Class: ChangeLog(object)
+#    - __init__(snapshot_filename, compact_threshold, compact_interval)
+#    - load()
+#    - record_set(path, value) / record_delete(path)
+#    - commit() / discard()
+#    - savepoint() / rollback_to(savepoint)
+#    - compact()
+#    - close()
+#
+"""
+
+import os
+import json
+import logging
+import threading
+
+
+OP_SET = "set"
+OP_DELETE = "del"
+
+
+class ChangeLog:
+    """An append-only log of Database changes on top of a JSON snapshot file"""
+    def __init__(self, snapshot_filename, compact_threshold=1000, compact_interval=60.0):
+        """Initialize the ChangeLog for the snapshot file"""
+        self._snapshot_filename = snapshot_filename
+        self._log_filename = snapshot_filename + ".log"
+        self._compacting_filename = snapshot_filename + ".log.compacting"
+        self._compact_threshold = compact_threshold
+        self._compact_interval = compact_interval
+
+        self._pending = []
+        self._pending_generation = 0
+        self._pending_lock = threading.Lock()
+        self._file_write_lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._committed_count = 0
+
+        self._compact_event = threading.Event()
+        self._closed = False
+        self._compact_thread = None
+
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    def load(self):
+        """Retrieve the persisted database: the snapshot with the change log replayed on top of it
+
+        Any changes that have not been committed are discarded, a ValueError is raised if the
+        snapshot is not properly formatted JSON
+        """
+        self.discard()
+
+        with self._compact_lock, self._file_write_lock:
+            with open(self._snapshot_filename, "r") as snapshot_file:
+                data = json.load(snapshot_file)
+
+            self._committed_count = 0
+            for log_filename in (self._compacting_filename, self._log_filename):
+                self._truncate_torn_record(log_filename)
+                self._committed_count += self._replay(log_filename, data)
+
+        return data
+
+    def record_set(self, path, value):
+        """Record that the path has been set to the value"""
+        with self._pending_lock:
+            self._pending.append((OP_SET, path, value))
+
+    def record_delete(self, path):
+        """Record that the path has been deleted"""
+        with self._pending_lock:
+            self._pending.append((OP_DELETE, path, None))
+
+    def discard(self):
+        """Drop the changes that have been recorded but not committed"""
+        with self._pending_lock:
+            self._pending = []
+            self._pending_generation += 1
+
+    def savepoint(self):
+        """Retrieve a marker for the changes recorded so far"""
+        with self._pending_lock:
+            return (self._pending_generation, len(self._pending))
+
+    def rollback_to(self, savepoint):
+        """Drop the changes recorded after the savepoint
+
+        Returns False if they can no longer be dropped because they have been committed or discarded
+        """
+        generation, pending_len = savepoint
+        with self._pending_lock:
+            if generation != self._pending_generation:
+                return False
+            del self._pending[pending_len:]
+        return True
+
+    def commit(self):
+        """Append the recorded changes to the change log with a single write and fsync
+
+        If they can't be serialized (TypeError) or written (OSError) they stay pending, and nothing
+        of them is left in the change log
+        """
+        with self._pending_lock:
+            # Serialized before they are taken, so that a value that isn't JSON doesn't lose them
+            records = "".join(json.dumps(change) + "\n" for change in self._pending).encode("utf-8")
+            pending = self._pending
+            self._pending = []
+            self._pending_generation += 1
+
+        if not pending:
+            return
+
+        with self._file_write_lock:
+            log_size = None
+            try:
+                with open(self._log_filename, "ab") as log_file:
+                    log_size = log_file.tell()
+                    log_file.write(records)
+                    log_file.flush()
+                    os.fsync(log_file.fileno())
+            except OSError:
+                # Remove whatever part of the records was written, a retry would append to a torn line
+                if log_size is not None:
+                    self._truncate_log(log_size)
+
+                # Keep the changes pending (ahead of any recorded since), so that they aren't lost
+                with self._pending_lock:
+                    self._pending[:0] = pending
+                raise
+            self._committed_count += len(pending)
+
+            self._start_compactor()
+            if self._committed_count >= self._compact_threshold:
+                self._compact_event.set()
+
+    def compact(self):
+        """Fold the change log into a new snapshot file"""
+        with self._compact_lock:
+            # Move the current change log aside so that commits can continue while compacting
+            with self._file_write_lock:
+                if os.path.exists(self._log_filename):
+                    if os.path.exists(self._compacting_filename):
+                        # A previous compaction didn't finish, fold the current change log in behind it
+                        with open(self._log_filename, "r") as log_file:
+                            records = log_file.read()
+                        with open(self._compacting_filename, "a") as compacting_file:
+                            compacting_file.write(records)
+                        os.remove(self._log_filename)
+                    else:
+                        os.replace(self._log_filename, self._compacting_filename)
+                elif not os.path.exists(self._compacting_filename):
+                    return
+                self._committed_count = 0
+
+            with open(self._snapshot_filename, "r") as snapshot_file:
+                data = json.load(snapshot_file)
+            self._replay(self._compacting_filename, data)
+
+            tmp_filename = self._snapshot_filename + ".tmp"
+            with open(tmp_filename, "w") as tmp_file:
+                json.dump(data, tmp_file, indent=4)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_filename, self._snapshot_filename)
+            os.remove(self._compacting_filename)
+
+            self._log.debug("compact: Wrote %d entries to snapshot [%s]", len(data), self._snapshot_filename)
+
+    def close(self):
+        """Stop the background compaction thread"""
+        self._closed = True
+        self._compact_event.set()
+        if self._compact_thread is not None:
+            self._compact_thread.join()
+            self._compact_thread = None
+
+    def _start_compactor(self):
+        """Start the background compaction thread if it isn't already running"""
+        if self._compact_thread is None and not self._closed:
+            self._compact_thread = threading.Thread(target=self._compact_loop, name="ChangeLogCompactor",
+                                                    daemon=True)
+            self._compact_thread.start()
+
+    def _compact_loop(self):
+        """Compact when asked to, or periodically while there are committed changes"""
+        while not self._closed:
+            self._compact_event.wait(self._compact_interval)
+            self._compact_event.clear()
+
+            if not self._closed and self._committed_count > 0:
+                try:
+                    self.compact()
+                except (OSError, ValueError) as compact_err:
+                    self._log.error("Unable to compact the change log into [%s]: %s",
+                                    self._snapshot_filename, compact_err)
+
+    def _truncate_log(self, log_size):
+        """Cut the change log back to log_size bytes after a failed commit"""
+        try:
+            os.truncate(self._log_filename, log_size)
+        except OSError as truncate_err:
+            self._log.error("Unable to remove the partially written records from [%s]: %s",
+                            self._log_filename, truncate_err)
+
+    def _truncate_torn_record(self, log_filename):
+        """Remove a partially written last record so that later commits start on a fresh line"""
+        try:
+            with open(log_filename, "rb+") as log_file:
+                records = log_file.read()
+                if records and not records.endswith(b"\n"):
+                    self._log.warning("Truncating partially written change log record in [%s]", log_filename)
+                    log_file.truncate(records.rfind(b"\n") + 1)
+        except FileNotFoundError:
+            pass
+
+    def _replay(self, log_filename, data):
+        """Apply the changes in the log file to the data, returning the number applied"""
+        count = 0
+
+        try:
+            with open(log_filename, "r") as log_file:
+                for line in log_file:
+                    try:
+                        operation, path, value = json.loads(line)
+                    except ValueError:
+                        self._log.warning("Ignoring malformed change log record in [%s]: %r", log_filename, line)
+                        continue
+
+                    if operation == OP_SET:
+                        data[path] = value
+                    elif operation == OP_DELETE:
+                        data.pop(path, None)
+                    count += 1
+        except FileNotFoundError:
+            pass
+
+        return count
@@ -3,103 +3,169 @@ import re
 import json
 import time
 import logging
+import sys
+import enum
 import datetime
 import threading
+import xml.etree.ElementTree as ET
+from collections import namedtuple
 
 import pprint
 
-class DataType:
-    def __init__(self):
-        self._name = None
-        self._type = None
-        self._description = None
-        self._base = None
+import utils
+import schema_cache
 
-    def from_dict(self, type_dict):
+def _strip_ns(tag):
+    """Strip the {namespace} of an XML tag or attribute name"""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _elem_to_dict(elem):
+    """Convert an XML element into the value xml2json --strip_text --strip_namespace gives it"""
+    d = {}
+    for key, value in elem.attrib.items():
+        d[sys.intern('@' + _strip_ns(key))] = value
+
+    for subelem in elem:
+        tag = sys.intern(_strip_ns(subelem.tag))
+        value = _elem_to_dict(subelem)
+        if tag not in d:
+            d[tag] = value
+        elif isinstance(d[tag], list):
+            d[tag].append(value)
+        else:
+            d[tag] = [d[tag], value]
+
+    text = elem.text.strip() if elem.text else None
+    tail = elem.tail.strip() if elem.tail else None
+    if tail:
+        d['#tail'] = tail
+
+    if d:
+        if text:
+            d['#text'] = text
+        return d
+    return text or None
+
+
+# The records are built while a DataModel parses, DataModel passes them its own logger
+_log = logging.getLogger("DataModel")
+
+
+def _intern(value):
+    """Intern a string, so that every record holding it shares one copy
+
+    Object paths are interned whole rather than per segment: they are the index keys and are
+    concatenated with parameter names, and a path joined from interned segments would be a new,
+    unshared string anyway. Parameter names, the other segments, are interned individually.
+    """
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Access(enum.IntEnum):
+    """The access of a data model object or parameter"""
+    READ_ONLY = 0
+    READ_WRITE = 1
+    WRITE_ONCE_READ_ONLY = 2
+
+    @classmethod
+    def from_name(cls, name):
+        """Retrieve the Access of its data model name (e.g. "readOnly")"""
+        try:
+            return _ACCESS_BY_NAME[name]
+        except KeyError:
+            raise ValueError("Unknown access [{}]".format(name)) from None
+
+    def __str__(self):
+        """Return the data model name of the access"""
+        return _ACCESS_NAMES[self]
+
+
+_ACCESS_NAMES = {
+    Access.READ_ONLY: "readOnly",
+    Access.READ_WRITE: "readWrite",
+    Access.WRITE_ONCE_READ_ONLY: "writeOnceReadOnly",
+}
+_ACCESS_BY_NAME = {name: access for access, name in _ACCESS_NAMES.items()}
+
+# The '@'-prefixed object attributes that are kept as they are -> their Model field
+_MODEL_ATTRS = {
+    '@name': 'path',
+    '@minEntries': 'min_entries',
+    '@maxEntries': 'max_entries',
+    '@numEntriesParameter': 'num_entries_parameter',
+    '@enableParameter': 'enable_parameter',
+    '@version': 'version',
+    '@mountPoint': 'mount_point',
+    '@mountType': 'mount_type',
+}
+_MODEL_IGNORED_KEYS = ('@noUniqueKeys', 'uniqueKey', 'parameter', 'command', 'event', 'description')
+_DATA_TYPE_TYPES = ('string', 'unsignedLong', 'unsignedInt', 'int', 'size', 'list')
+
+
+class DataType(namedtuple("DataType", ("name", "base", "type", "description"))):
+    """A named data type of the data model"""
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, type_dict, log=_log):
+        """Build the DataType from its xml2json conversion, logging the keys it doesn't know"""
+        name = base = data_type = description = None
         for key in type_dict:
             if '@name' == key:
-                self._name = type_dict['@name']
+                name = type_dict['@name']
             elif '@base' == key:
-                self._base = type_dict['@base']
-            elif 'string' == key:
-                self._type = 'string'
-            elif 'unsignedLong' == key:
-                self._type = 'unsignedLong'
-            elif 'unsignedInt' == key:
-                self._type = 'unsignedInt'
-            elif 'int' == key:
-                self._type = 'int'
-            elif 'size' == key:
-                self._type = 'size'
-            elif 'list' == key:
-                self._type = 'list'
+                base = type_dict['@base']
+            elif key in _DATA_TYPE_TYPES:
+                data_type = key
             elif 'description' == key:
-                self._description = type_dict['description']
+                description = type_dict['description']
             else:
-                print("UNKNOWN KEY:  "+key+"  VALUE: "+type_dict[key])
+                log.warning("Unknown dataType key [%s]: %s", key, type_dict[key])
+        return cls(_intern(name), _intern(base), _intern(data_type), description)
 
-    def __str__(self):
-        return "name: "+str(self._name)+" type:"+str(self._type)
-
-
-class Model(object):
-    def __init__(self):
-        self._path = None
-        self._type = None
-        self._description = None
-        self._access = None
-        self._maxEntries = None
-        self._minEntries = None
-        self._version = None
-        self._numEntriesParameter = None
-
-        self._uniqueKeys = {}
-        self._parameter = {}
-        self._event = {}
-        self._command = {}
-
-    def from_dict(self, model_dict):
+
+class Parameter(namedtuple("Parameter", ("name", "access", "syntax"))):
+    """A parameter of a data model object
+
+    Its syntax is kept as canonical JSON, so that it is as immutable as the record, and shared with
+    the parameters of the same syntax
+    """
+    __slots__ = ()
+
+    def syntax_dict(self):
+        """Retrieve the syntax as a new dict"""
+        return json.loads(self.syntax)
+
+
+class Model(namedtuple("Model", ("path", "access", "min_entries", "max_entries", "num_entries_parameter",
+                                 "enable_parameter", "version", "fixed_object", "mount_point", "mount_type",
+                                 "parameters"))):
+    """A data model object, the attributes that it doesn't have are None"""
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, model_dict, parameters=(), log=_log):
+        """Build the Model from its xml2json conversion (only its '@'-prefixed attributes are needed)
+
+        The keys it doesn't know are logged
+        """
+        fields = dict.fromkeys(cls._fields)
+        fields['fixed_object'] = False
+        fields['parameters'] = tuple(parameters)
         for key in model_dict:
-            if '@name' == key:
-                self._path = model_dict['@name']
+            if key in _MODEL_ATTRS:
+                fields[_MODEL_ATTRS[key]] = _intern(model_dict[key])
             elif '@access' == key:
-                self._access = model_dict['@access']
-            elif 'uniqueKey' == key:
-                pass
-            elif '@noUniqueKeys' == key:
-                pass
+                fields['access'] = Access.from_name(model_dict['@access'])
             elif '@fixedObject' == key:
-                self._fixedObject = True
-            elif 'parameter' == key:
-                pass
-            elif 'command' == key:
-                pass
-            elif 'event' == key:
+                fields['fixed_object'] = True
+            elif key in _MODEL_IGNORED_KEYS:
                 pass
-            elif 'description' == key:
-                self._description = model_dict['description']
-            elif '@maxEntries' == key:
-                self._maxEntries = model_dict['@maxEntries']
-            elif '@minEntries' == key:
-                self._minEntries = model_dict['@minEntries']
-            elif '@version' == key:
-                self._version = model_dict['@version']
-            elif '@mountPoint' == key:
-                self._mountPoint = model_dict['@mountPoint']
-            elif '@mountType' == key:
-                self._mountType = model_dict['@mountType']
-            elif '@enableParameter' == key:
-                self._enableParameter = model_dict['@enableParameter']
-            elif '@numEntriesParameter' == key:
-                self._numEntriesParameter = model_dict['@numEntriesParameter']
             else:
-                print("UNKNOWN KEY:  "+key+"  VALUE: "+str(model_dict[key]))
-
-    def __str__(self):
-        return "path: "+str(self._path)+" access:"+str(self._access)
+                log.warning("Unknown object key [%s] of [%s]: %s", key, model_dict.get('@name'), model_dict[key])
+        return cls(**fields)
 
-    def __repr__(self):
-        return self.__dict__
 
 class DataModel(object):
     """Represents a datamodel"""
@@ -114,92 +180,104 @@ class DataModel(object):
         self._log = logging.getLogger(self.__class__.__name__)
         self._log.debug("Initializing the Database...")
 
-        # Retrieve the Implemented Data Model
-        with open(dm_filename, "r") as dm_in_json:
-            try:
-                self._dm = json.load(dm_in_json)
-            except ValueError as parse_err:
-                self._dm = {}
-                self._log.error("Implemented Data Model is NOT properly formatted JSON: %s", parse_err)
+        # Retrieve the model index, only parsing the file when its compiled form is stale
+        self._dm = None
+        self._syntaxes = {}
+        self._model = schema_cache.load(dm_filename, "datamodel", self._compile)
+
+    def _compile(self, dm_filename):
+        """Parse the data model file (TR-181 XML or its xml2json conversion) into the model index"""
+        if dm_filename.endswith(".xml"):
+            # Read the TR-181 XML directly, there's no need for its JSON conversion
+            self.parseXml(dm_filename)
+        else:
+            # Retrieve the Implemented Data Model
+            with open(dm_filename, "r") as dm_in_json:
+                try:
+                    self._dm = json.load(dm_in_json)
+                except ValueError as parse_err:
+                    self._dm = {}
+                    self._log.error("Implemented Data Model is NOT properly formatted JSON: %s", parse_err)
+
+            self.parseJson()
+
+        # Only needed while parsing
+        self._syntaxes.clear()
+        return self._model
 
-        self.parseJson()
+    def _new_parameter(self, name, access, syntax):
+        """Build a Parameter, sharing its syntax with the parameters that have an identical one"""
+        syntax = json.dumps(syntax, sort_keys=True)
+        syntax = self._syntaxes.setdefault(syntax, syntax)
+        return Parameter(sys.intern(name), Access.from_name(access), syntax)
 
     def parseParams(self, params):
-        items = []
-        #pprint.pprint(params)
-        if isinstance(params, list):
-            for param in params:
-                item = {}
-                if '@name' in param:
-                    #pprint.pprint(param)
-                    item['name'] = param['@name']
-                    item['access'] = param['@access']
-                    item['syntax'] = param['syntax']
-                items.append(item)
+        """Build the Parameters of an object's "parameter" (a list, or a dict if there is only one)"""
+        if not isinstance(params, list):
+            params = [params]
 
-        else:
-            if '@name' in params:
-                item = {}
-                #pprint.pprint(param)
-                item['name'] = params['@name']
-                item['access'] = params['@access']
-                item['syntax'] = params['syntax']
-                items.append(item)
-        return items
+        return tuple(self._new_parameter(param['@name'], param['@access'], param['syntax'])
+                     for param in params if '@name' in param)
 
     def parseJson(self):
         self._model = {}
         for dtype in self._dm['document']['dataType']:
-            d = DataType()
-            d.from_dict(dtype)
+            DataType.from_dict(dtype, self._log)
 
         for model in self._dm['document']['model']['object']:
-            #m = Model()
-            #m.from_dict(model)
-            data = {}
-            for key in model:
-                if '@name' == key:
-                    #data['path'] = model['@name']
-                    pass
-                elif '@access' == key:
-                    data['access'] = model['@access']
-                elif 'uniqueKey' == key:
-                    pass
-                elif '@noUniqueKeys' == key:
-                    pass
-                elif '@fixedObject' == key:
-                    data['fixedObject'] = True
-                elif 'parameter' == key:
-                    data['parameter'] = self.parseParams(model['parameter'])
-                elif 'command' == key:
-                    pass
-                elif 'event' == key:
-                    pass
-                elif 'description' == key:
-                    #data['description'] = model['description']
-                    pass
-                elif '@maxEntries' == key:
-                    data['maxEntries'] = model['@maxEntries']
-                elif '@minEntries' == key:
-                    data['minEntries'] = model['@minEntries']
-                elif '@version' == key:
-                    data['version'] = model['@version']
-                elif '@mountPoint' == key:
-                    data['mountPoint'] = model['@mountPoint']
-                elif '@mountType' == key:
-                    data['mountType'] = model['@mountType']
-                elif '@enableParameter' == key:
-                    data['enableParameter'] = model['@enableParameter']
-                elif '@numEntriesParameter' == key:
-                    data['numEntriesParameter'] = model['@numEntriesParameter']
-                else:
-                    print("UNKNOWN KEY:  "+key+"  VALUE: "+str(model[key]))
-            self._model[model['@name']] = data 
+            obj = Model.from_dict(model, self.parseParams(model.get('parameter', [])), self._log)
+            self._model[obj.path] = obj
+
+    def parseXmlParams(self, obj_elem):
+        """Build the Parameters of an <object> element"""
+        return tuple(self._new_parameter(param.attrib['name'], param.attrib['access'],
+                                         _elem_to_dict(next(sub for sub in param if _strip_ns(sub.tag) == 'syntax')))
+                     for param in obj_elem
+                     if _strip_ns(param.tag) == 'parameter' and 'name' in param.attrib)
+
+    def parseXmlObject(self, obj_elem):
+        """Build the Model of an <object> element"""
+        attrs = {'@' + _strip_ns(key): value for key, value in obj_elem.attrib.items()}
+        return Model.from_dict(attrs, self.parseXmlParams(obj_elem), self._log)
+
+    def parseXml(self, xml_filename):
+        """Build the model index from the TR-181 XML in one streaming pass
+
+        Only the <object> elements of the <model> are kept, each one until it has been indexed
+        """
+        self._model = {}
+        stack = []
+        for event, elem in ET.iterparse(xml_filename, events=('start', 'end')):
+            if event == 'start':
+                stack.append(elem)
+                continue
+
+            stack.pop()
+            if len(stack) > 2:
+                # Within an <object>, it's indexed as a whole when it ends
+                continue
+
+            if len(stack) == 2 and _strip_ns(elem.tag) == 'object' and _strip_ns(stack[1].tag) == 'model':
+                obj = self.parseXmlObject(elem)
+                self._model[obj.path] = obj
+
+            # Drop everything (<description>, <dataType>, <profile>, ...) that has been looked at
+            elem.clear()
+            if stack:
+                stack[-1].remove(elem)
+
+        self._log.debug("Indexed %d objects from [%s]", len(self._model), xml_filename)
+
+    def iter_param_access(self):
+        """Yield the (generic parameter path, access) of every parameter of the model"""
+        for obj_path, obj in self._model.items():
+            for param in obj.parameters:
+                yield obj_path + param.name, str(param.access)
 
     def find_path_attrs(self, path):
         partial_path, param = self._strip_path(path)
 
-        param_dict = {x['name']: x for x in self._model[partial_path]['parameter']}
+        param_dict = {x.name: x for x in self._model[partial_path].parameters}
 
         if not param:
             pprint.pprint(self._model[partial_path])
@@ -209,21 +287,12 @@ class DataModel(object):
         return (partial_path, param)
 
     def _dm_regex(self, path, partial_path):
-        """Generate a regex for determining whether or not a path is in the DM"""
-        dm_regex_str = "^" + path  # Starts with
-        dm_regex_str = re.sub(r'\.[0-9]+\.', r'.{i}.', dm_regex_str)  # Instance Number Addressing
-        dm_regex_str = re.sub(r'\.\*\.', r'.{i}.', dm_regex_str)  # Wild-card Searching
-        dm_regex_str = re.sub(r'\.', r'\.', dm_regex_str)  # Replace '.' with explicit '.' search
-
-        if partial_path:
-            dm_regex_str = dm_regex_str + ".*"
-
-        return dm_regex_str
+        """Retrieve the compiled regex for determining whether or not a path is in the DM"""
+        return utils.PathHelper.dm_regex(path, partial_path)
 
     def _generic_dm_path(self, path):
         """Turn a DM Path into a Generic one by replacing instance numbers and wildcards"""
-        generic_path = re.sub(r'\.[0-9]+\.', r'.{i}.', path)  # Instance Number Addressing
-        generic_path = re.sub(r'\.\*\.', r'.{i}.', generic_path)  # Wild-card Searching
+        return utils.PathHelper.generic_dm_path(path)
 
     def _strip_path(self, path):
         obj_path = re.sub(r'\.*\.([^\.]*)$', r'.', path)
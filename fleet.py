@@ -0,0 +1,216 @@
+"""
+# File Name: fleet.py
+#
+# Description: Fleet-wide Device Twin Collection
+#
+# Functionality:
+#  - Retrieves the Device Twin of every MAC in a list (or stream) of MACs
+#  - At most max_in_flight devices are collected at once, and no more than rate_limit
+#    devices are started per second
+#  - The WebPA requests of a run go through its own pool of max_requests workers, so that no
+#    more than max_requests are in flight whatever the number of subtrees per device
+#  - Subtree samples aren't reused (each device is collected once), unless the run is given a
+#    twin_cache.SubtreeCache to keep them in
+#  - Twins are written out as JSON lines ({"mac": ..., "twin": {...}}) as soon as they complete
+#  - Throughput and error counters are kept for each run, a twin that is missing some of its
+#    subtrees is written out but counted as partial
+#
+#   Class: RateLimiter(object)
+#    - __init__(rate)
+#    - acquire()
+#   Class: CollectionStats(object)
+#    - __init__()
+#    - record_success() / record_partial(failed_paths) / record_failure(err)
+#    - summary()
+#   Function: collect_twins(base_url, creds, macs, out_file, max_in_flight, rate_limit, max_requests, samples)
+#
+# Usage: python fleet.py [--in-flight N] [--requests N] [--rate N] [--output FILE] [MAC_FILE]
+#        (MACs are read one per line, from stdin if no MAC_FILE is given)
+#
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import concurrent.futures
+from dotenv import load_dotenv
+
+import nucleus
+import metrics
+import webpa
+import twin_cache
+
+
+DEFAULT_MAX_IN_FLIGHT = 16
+# Half of the shared WebPA connection pool, the rest is left to whatever else uses it
+DEFAULT_MAX_REQUESTS = webpa.WEBPA_POOL_SIZE // 2
+
+
+class RateLimiter:
+    """Spaces calls to acquire() so that no more than rate happen per second"""
+    def __init__(self, rate):
+        """Initialize the RateLimiter, a rate of None (or 0) means unlimited"""
+        self._interval = 1.0 / rate if rate else 0.0
+        self._next_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until the next call is allowed"""
+        if not self._interval:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self._interval
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class CollectionStats:
+    """The throughput and error counters of a single collection run"""
+    def __init__(self):
+        """Initialize the CollectionStats"""
+        self._start_time = time.monotonic()
+        self._lock = threading.Lock()
+        self.succeeded = 0
+        self.partial = 0
+        self.failed = 0
+        self.errors = {}
+        self.failed_paths = {}
+
+    def record_success(self):
+        """Count a Device Twin that was collected"""
+        with self._lock:
+            self.succeeded += 1
+        metrics.count_fleet_twin("success")
+
+    def record_partial(self, failed_paths):
+        """Count a Device Twin that was collected without some of its subtrees, by the reason they failed"""
+        with self._lock:
+            self.partial += 1
+            for reason in failed_paths.values():
+                self.failed_paths[reason] = self.failed_paths.get(reason, 0) + 1
+        metrics.count_fleet_twin("partial")
+
+    def record_failure(self, err):
+        """Count a Device Twin that couldn't be collected, by the type of error"""
+        error_name = type(err).__name__
+        with self._lock:
+            self.failed += 1
+            self.errors[error_name] = self.errors.get(error_name, 0) + 1
+        metrics.count_fleet_twin("failure")
+
+    def summary(self):
+        """Retrieve the counters of the run so far"""
+        with self._lock:
+            elapsed = time.monotonic() - self._start_time
+            total = self.succeeded + self.partial + self.failed
+            return {
+                "devices": total,
+                "succeeded": self.succeeded,
+                "partial": self.partial,
+                "failed": self.failed,
+                "errors": dict(self.errors),
+                "failed_paths": dict(self.failed_paths),
+                "seconds": round(elapsed, 3),
+                "devices_per_second": round(total / elapsed, 2) if elapsed > 0 else 0.0,
+            }
+
+
+def collect_twins(base_url, creds, macs, out_file, max_in_flight=DEFAULT_MAX_IN_FLIGHT, rate_limit=None,
+                  max_requests=DEFAULT_MAX_REQUESTS, samples=None):
+    """Collect the Device Twin of every MAC, writing each one to out_file as it completes
+
+    macs can be any iterable (including a generator), only max_in_flight MACs are pulled from it
+    ahead of the collections that have completed. At most max_requests WebPA requests are in flight,
+    no more than the connections that the shared WebPA client keeps (webpa.WEBPA_POOL_SIZE).
+    samples is the twin_cache.SubtreeCache of the run, by default no samples are kept (the shared
+    nucleus.device_subtree_cache isn't filled). Returns the CollectionStats of the run.
+    """
+    log = logging.getLogger("collect_twins")
+    stats = CollectionStats()
+    limiter = RateLimiter(rate_limit)
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    write_lock = threading.Lock()
+    if samples is None:
+        samples = twin_cache.SubtreeCache(0)
+
+    if max_requests > webpa.WEBPA_POOL_SIZE:
+        # Requests beyond the pool would each open a connection that is thrown away afterwards
+        log.warning("Limiting the WebPA requests in flight to the connection pool size: %d",
+                    webpa.WEBPA_POOL_SIZE)
+        max_requests = webpa.WEBPA_POOL_SIZE
+
+    def collect(mac):
+        try:
+            nd = nucleus.NucleusDevice(base_url, creds, mac, samples=samples, executor=request_executor)
+            twin = nd.get()
+        except Exception as err:
+            stats.record_failure(err)
+            log.warning("Unable to collect the Device Twin of [%s]: %s", mac, err)
+        else:
+            with write_lock:
+                out_file.write('{"mac": ' + json.dumps(mac) + ', "twin": ' + twin + '}\n')
+            if nd.failed_paths:
+                stats.record_partial(nd.failed_paths)
+                log.warning("Collected the Device Twin of [%s] without %s", mac, nd.failed_paths)
+            else:
+                stats.record_success()
+        finally:
+            in_flight.release()
+
+    # The devices only wait on their requests, the request workers bound the WebPA requests in flight
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_requests,
+                                               thread_name_prefix="FleetWebPA") as request_executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight,
+                                                  thread_name_prefix="FleetCollector") as executor:
+        for mac in macs:
+            mac = mac.strip()
+            if not mac:
+                continue
+
+            in_flight.acquire()
+            limiter.acquire()
+            executor.submit(collect, mac)
+
+    out_file.flush()
+    log.info("collect_twins: %s", stats.summary())
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collect the Device Twins of a fleet of devices")
+    parser.add_argument("mac_file", nargs="?", help="file of MACs, one per line (default: stdin)")
+    parser.add_argument("--in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                        help="maximum number of devices collected at once")
+    parser.add_argument("--requests", type=int, default=DEFAULT_MAX_REQUESTS,
+                        help="maximum number of WebPA requests in flight (at most {})".format(webpa.WEBPA_POOL_SIZE))
+    parser.add_argument("--rate", type=float, default=None, help="maximum number of devices started per second")
+    parser.add_argument("--output", default=None, help="file to write the JSON lines to (default: stdout)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    creds = os.getenv("TOKEN")
+    base_url = os.getenv("BASE_URL")
+
+    mac_file = open(args.mac_file, "r") if args.mac_file else sys.stdin
+    out_file = open(args.output, "w") if args.output else sys.stdout
+    try:
+        stats = collect_twins(base_url, creds, mac_file, out_file, args.in_flight, args.rate, args.requests)
+    finally:
+        if args.mac_file:
+            mac_file.close()
+        if args.output:
+            out_file.close()
+
+    sys.stderr.write(json.dumps(stats.summary()) + "\n")
+
+
+if __name__ == "__main__":
+    main()
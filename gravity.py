@@ -6,9 +6,8 @@ import datetime
 import threading
 import pprint
 import utils
-import operator
-import functools
-from collections import defaultdict
+import path_index
+import metrics
 
 class Database:
     """Represents a simple database"""
@@ -34,36 +33,23 @@ class Database:
         self._log = logging.getLogger(self.__class__.__name__)
         self._log.debug("Initializing the Database...")
 
-        # Retrieve the Implemented Data Model
-        with open(dm_filename, "r") as dm_in_json:
-            try:
-                self._dm = json.load(dm_in_json)
-            except ValueError as parse_err:
-                self._dm = {}
-                self._log.error("Implemented Data Model is NOT properly formatted JSON: %s", parse_err)
+        # Retrieve the Implemented Data Model, and index it so that validating a path is a lookup, not a scan
+        try:
+            self._dm, self._schema = path_index.load_dm(dm_filename)
+        except ValueError as parse_err:
+            self._dm = {}
+            self._schema = path_index.SchemaIndex(self._dm)
+            self._log.error("Implemented Data Model is NOT properly formatted JSON: %s", parse_err)
 
         #Load DB
         self.reset()
 
     def __repr__(self):
-        def dd_to_dict(d):
-            if isinstance(d, defaultdict):
-                d = {k: dd_to_dict(v) for k, v in d.items()}
-            return d
-
-        result = {}
-
-        infinitedict = lambda: defaultdict(infinitedict)
-        result = infinitedict()
-
-        for entry in self._db:
-            keys = entry.split('.')
-            lastplace = functools.reduce(operator.getitem, keys[:-1], result)
-            lastplace[keys[-1]] = self._db[entry]
-        return str(json.dumps(dd_to_dict(result)))
+        # Streamed straight from the sorted flat paths, no nested copy of the DB is built
+        return utils.TreeHelper.to_json(self._db)
 
 
-    #@DB_GET_SUMMARY_METRIC.time()
+    @metrics.instrument("gravity", "get")
     def get(self, path):
         """Retrieve the value of the incoming path, or throw a NoSuchPathError"""
         value = None
@@ -107,13 +93,13 @@ class Database:
         dm_param_path = self._generic_dm_path(path)
 
         # Validate that path is in the Implemented Data Model
-        if dm_param_path in self._dm:
+        if self._schema.is_param(dm_param_path):
             self._db[path] = value
             #self._save()
         else:
             raise NoSuchPathError(path)
 
-    #@DB_UPDATE_SUMMARY_METRIC.time()
+    @metrics.instrument("gravity", "update")
     def update(self, path, value):
         """Change the value of the incoming path, or throw a NoSuchPathError"""
         if self.is_param_writable(path):
@@ -121,33 +107,27 @@ class Database:
         else:
             raise NoSuchPathError(path)
 
-    #@DB_FIND_PARAMS_SUMMARY_METRIC.time()
+    @metrics.instrument("gravity", "find_params", result_size=True)
     def find_params(self, path):
         """Retrieve a set of parameter paths that match the incoming path"""
         found_keys = []
-        is_implemented_path = False
-
-        # Turn the incoming path into a regex to validate it is in the implemented data model
-        dm_regex_str = self._dm_regex(path, path.endswith("."))
-        self._log.debug("find_params: Using regex \"%s\" to validate Path [%s] is in the Implemented Data Model",
-                     dm_regex_str, path)
+        dm_path = self._generic_dm_path(path)
 
         # Turn the incoming path into a regex to get the matching paths
-        db_regex_str = self._db_regex(path, path.endswith("."))
+        db_regex = self._db_regex(path, path.endswith("."))
         self._log.debug("find_params: Using regex \"%s\" to retrieve values from the Database for Path [%s]",
-                     db_regex_str, path)
+                     db_regex.pattern, path)
 
         # Validate that path is in the Implemented Data Model
-        dm_keys = self._dm.keys()
-        for dm_key in dm_keys:
-            if re.fullmatch(dm_regex_str, dm_key) is not None:
-                is_implemented_path = True
-                break
+        if path.endswith("."):
+            is_implemented_path = self._schema.is_object(dm_path)
+        else:
+            is_implemented_path = self._schema.is_param(dm_path)
 
         # If the path is Valid then retrieve the matching paths
         if is_implemented_path:
             for param_path in self._db:
-                if re.fullmatch(db_regex_str, param_path) is not None:
+                if db_regex.fullmatch(param_path) is not None:
                     path_parts = param_path.split(".")
                     path_part_len = len(path_parts) - 1
 
@@ -167,49 +147,37 @@ class Database:
         dm_param_path = self._generic_dm_path(param_path)
 
         # Validate that path is in the Implemented Data Model
-        if dm_param_path in self._dm:
-            if self._dm[dm_param_path] == "readWrite":
+        if self._schema.is_param(dm_param_path):
+            if self._schema.get_access(dm_param_path) == "readWrite":
                 is_writable = True
         else:
             raise NoSuchPathError(dm_param_path)
 
         return is_writable
 
-    #@DB_FIND_INSTANCES_SUMMARY_METRIC.time()
+    @metrics.instrument("gravity", "find_instances", result_size=True)
     def find_instances(self, partial_path):
         """Retrieve a set of object instance paths that match the incoming path"""
-        found_keys = []
-        is_implemented_path = False
+        found_keys = {}
 
         if partial_path.endswith("."):
-            # Turn the incoming path into a regex to validate it is in the implemented data model
-            dm_regex_str = self._dm_regex(partial_path, True)
-            self._log.debug("find_instances: Using regex \"%s\" to validate Path [%s] is in the Implemented Data Model",
-                         dm_regex_str, partial_path)
-
             # Turn the incoming path into a regex to get the matching paths
-            db_regex_str = self._db_regex(partial_path, True)
+            db_regex = self._db_regex(partial_path, True)
             self._log.debug("find_instances: Using regex \"%s\" to retrieve values from the Database for Path [%s]",
-                         db_regex_str, partial_path)
+                         db_regex.pattern, partial_path)
         else:
             raise NoSuchPathError(partial_path)
 
         # length minus 1 due to the ending "." causing 1 more split
         partial_path_part_len = len(partial_path.split(".")) - 1
 
-        # Validate that path is in the Implemented Data Model
-        for dm_key in self._dm:
-            if re.fullmatch(dm_regex_str, dm_key) is not None:
-                # Validate that the partial_path is a multi-instance object
-                dm_key_parts = dm_key.split(".")
-                if dm_key_parts[partial_path_part_len] == "{i}":
-                    is_implemented_path = True
-                    break
+        # Validate that the partial_path is a multi-instance object in the Implemented Data Model
+        is_implemented_path = self._schema.is_table(self._generic_dm_path(partial_path))
 
         # If the path is Valid then retrieve the matching paths
         if is_implemented_path:
             for path in self._db:
-                if re.fullmatch(db_regex_str, path) is not None:
+                if db_regex.fullmatch(path) is not None:
                     # We only want the path to the next level (instance identifiers)
                     path_parts = path.split(".")
                     built_path = utils.PathHelper.build_path_from_parts(path_parts, partial_path_part_len)
@@ -217,29 +185,22 @@ class Database:
 
                     if not self._is_meta_parameter(path_parts, partial_path_part_len):
                         # Only add it to found_keys if we haven't done so already
-                        if found_key not in found_keys:
-                            found_keys.append(found_key)
+                        found_keys[found_key] = None
         else:
             raise NoSuchPathError(partial_path)
 
-        return found_keys
+        return list(found_keys)
 
-    #@DB_FIND_OBJECTS_SUMMARY_METRIC.time()
+    @metrics.instrument("gravity", "find_objects", result_size=True)
     def find_objects(self, partial_path):
         """Retrieve a set of instantiated object paths that match the incoming path"""
-        found_keys = []
-        is_implemented_path = False
+        found_keys = {}
 
         if partial_path.endswith("."):
-            # Turn the incoming path into a regex to validate it is in the implemented data model
-            dm_regex_str = self._dm_regex(partial_path, True)
-            self._log.debug("find_objects: Using regex \"%s\" to validate Path [%s] is in the Implemented Data Model",
-                         dm_regex_str, partial_path)
-
             # Turn the incoming path into a regex to get the matching paths
-            db_regex_str = self._db_regex(partial_path, True)
+            db_regex = self._db_regex(partial_path, True)
             self._log.debug("find_objects: Using regex \"%s\" to retrieve values from the Database for Path [%s]",
-                         db_regex_str, partial_path)
+                         db_regex.pattern, partial_path)
         else:
             raise NoSuchPathError(partial_path)
 
@@ -247,87 +208,47 @@ class Database:
         partial_path_part_len = len(partial_path.split(".")) - 1
 
         # Validate that path is in the Implemented Data Model
-        for dm_key in self._dm:
-            if re.fullmatch(dm_regex_str, dm_key) is not None:
-                is_implemented_path = True
-                break
+        is_implemented_path = self._schema.is_object(self._generic_dm_path(partial_path))
 
         # If the path is Valid then retrieve the matching paths
         if is_implemented_path:
             for path in self._db:
-                if re.fullmatch(db_regex_str, path) is not None:
+                if db_regex.fullmatch(path) is not None:
                     # We only want the path to the next level (instance identifiers)
                     path_parts = path.split(".")
                     found_key = utils.PathHelper.build_path_from_parts(path_parts, partial_path_part_len)
 
-                    if found_key not in found_keys:
-                        found_keys.append(found_key)
+                    # Only add it to found_keys if we haven't done so already
+                    found_keys[found_key] = None
         else:
             raise NoSuchPathError(partial_path)
 
-        return found_keys
+        return list(found_keys)
 
-    #@DB_FIND_IMPL_OBJECTS_SUMMARY_METRIC.time()
+    @metrics.instrument("gravity", "find_impl_objects", result_size=True)
     def find_impl_objects(self, partial_path, next_level):
         """Retrieve a set of implemented object paths that match the incoming path"""
-        found_keys = []
-        is_implemented_path = False
-        generic_partial_path = self._generic_dm_path(partial_path)
-
-        if partial_path.endswith("."):
-            # Turn the incoming path into a regex to validate it is in the implemented data model
-            dm_regex_str = self._dm_regex(partial_path, True)
-            self._log.debug(
-                "find_impl_objects: Using regex \"%s\" to validate Path [%s] is in the Implemented Data Model",
-                dm_regex_str, partial_path)
-        else:
+        if not partial_path.endswith("."):
             raise NoSuchPathError(partial_path)
 
-        # length minus 1 due to the ending "." causing 1 more split
-        partial_path_part_len = len(partial_path.split(".")) - 1
+        generic_partial_path = self._generic_dm_path(partial_path)
 
         # Validate that path is in the Implemented Data Model
-        for dm_key in self._dm:
-            if re.fullmatch(dm_regex_str, dm_key) is not None:
-                self._log.debug("find_impl_objects: Found full match: %s", dm_key)
-                found_key = None
-                key_parts = dm_key.split(".")
-                key_parts_len = len(key_parts)
-                is_implemented_path = True
-
-                if next_level:
-                    if key_parts_len > partial_path_part_len + 1:
-                        built_path = utils.PathHelper.build_path_from_parts(key_parts, partial_path_part_len)
-                        found_key = built_path + key_parts[partial_path_part_len] + "."
-                    else:
-                        print(key_parts)
-                        self._log.debug("find_impl_objects: key parts [%s] less than/equal partial path parts [%s]",
-                                     str(key_parts_len), str(partial_path_part_len + 1))
-                else:
-                    inx = 0
-                    found_key = ""
-                    while inx < (key_parts_len - 1):
-                        found_key += key_parts[inx]
-                        found_key += "."
-                        inx += 1
-
-                # Only add it to found_keys if we haven't done so already
-                if found_key is not None:
-                    self._log.debug("find_impl_objects: Found key: %s", found_key)
-                    if found_key not in found_keys:
-                        self._log.debug("find_impl_objects: Found key [%s] not already in the list", found_key)
-                        # Don't add the incoming partial_path
-                        if not found_key == generic_partial_path:
-                            self._log.debug("find_impl_objects: Adding found key [%s] to the list", found_key)
-                            found_keys.append(found_key)
-
-        # If the path is Valid then retrieve the matching paths
-        if not is_implemented_path:
+        if not self._schema.is_object(generic_partial_path):
             raise NoSuchPathError(partial_path)
 
+        if next_level:
+            # Only the objects directly below the partial path
+            found_keys = self._schema.get_child_objects(generic_partial_path)
+        else:
+            # The objects that contain the implemented parameters (other than the partial path itself)
+            found_keys = [found_key for found_key in self._schema.get_param_objects(generic_partial_path)
+                          if found_key != generic_partial_path]
+
+        self._log.debug("find_impl_objects: Found keys: %s", found_keys)
         return found_keys
 
-    #@DB_INSERT_SUMMARY_METRIC.time()
+    @metrics.instrument("gravity", "insert")
     def insert(self, partial_path):
         """Insert a new record in the table"""
 
@@ -366,7 +287,7 @@ class Database:
 
         return next_inst_num
 
-    #@DB_DELETE_SUMMARY_METRIC.time()
+    @metrics.instrument("gravity", "delete")
     def delete(self, partial_path):
         """Remove an existing record from the table"""
 
@@ -390,35 +311,12 @@ class Database:
             raise NoSuchPathError(partial_path)
 
     def _db_regex(self, path, partial_path):
-        """Generate a regex for determining whether or not a path is in the DB"""
-        db_regex_str = "^" + path
-        # Assuming that the internal storage is instance number based
-        db_regex_str = re.sub(r'\.\*\.', r'.[0-9]+.', db_regex_str)
-        db_regex_str = re.sub(r'\.', r'\.', db_regex_str)
-
-        if partial_path:
-            db_regex_str = db_regex_str + ".*"
-
-        return db_regex_str
-
-    def _dm_regex(self, path, partial_path):
-        """Generate a regex for determining whether or not a path is in the DM"""
-        dm_regex_str = "^" + path  # Starts with
-        dm_regex_str = re.sub(r'\.[0-9]+\.', r'.{i}.', dm_regex_str)  # Instance Number Addressing
-        dm_regex_str = re.sub(r'\.\*\.', r'.{i}.', dm_regex_str)  # Wild-card Searching
-        dm_regex_str = re.sub(r'\.', r'\.', dm_regex_str)  # Replace '.' with explicit '.' search
-
-        if partial_path:
-            dm_regex_str = dm_regex_str + ".*"
-
-        return dm_regex_str
+        """Retrieve the compiled regex for determining whether or not a path is in the DB"""
+        return utils.PathHelper.db_regex(path, partial_path)
 
     def _generic_dm_path(self, path):
         """Turn a DM Path into a Generic one by replacing instance numbers and wildcards"""
-        generic_path = re.sub(r'\.[0-9]+\.', r'.{i}.', path)  # Instance Number Addressing
-        generic_path = re.sub(r'\.\*\.', r'.{i}.', generic_path)  # Wild-card Searching
-
-        return generic_path
+        return utils.PathHelper.generic_dm_path(path)
 
     def _is_meta_parameter(self, path_parts, partial_path_part_len):
         """Determine if the parameter is a meta parameter"""
@@ -0,0 +1,183 @@
+"""
+# File Name: ingest.py
+#
+# Description: WebPA Result Ingest Pipeline
+#
+# Functionality:
+#  - Reads captured WebPA results: one or many result files, or NDJSON (one response per line)
+#  - Flattens and types every parameter (see webpa_response.py)
+#  - Optionally validates the parameters against an Implemented Data Model (a flat
+#    parameter path -> access map such as erdk-dm.json), dropping the parameters that it
+#    doesn't implement; the DB file is left alone if that drops every parameter
+#  - Writes the merged (full parameter path -> value) DB file, later inputs win on conflicts
+#  - Result files are processed in parallel by a process pool
+#
+#   Function: ingest_file(result_filename, schema=None)
+#   Function: ingest_lines(lines, schema=None)
+#   Function: ingest_files(result_filenames, db_filename, dm_filename=None, workers=None)
+#   Function: write_db(db, db_filename)
+#
+# Usage: python ingest.py [--dm DM_FILE] [--output DB_FILE] [--workers N] [RESULT_FILE ...]
+#        (NDJSON is read from stdin if no RESULT_FILE is given)
+#
+"""
+
+import os
+import sys
+import json
+import argparse
+import functools
+import concurrent.futures
+
+import utils
+import path_index
+import webpa_response
+
+
+INGEST_CHUNK_SIZE = 64 * 1024
+
+# The SchemaIndex of each pool worker process, built once by _init_worker
+_worker_schema = None
+
+
+def load_schema(dm_filename):
+    """Retrieve the SchemaIndex of the Implemented Data Model file, or None if there is no file
+
+    Raises ValueError if the file has no parameters, e.g. the nested xml2json model rather than a flat access map
+    """
+    if dm_filename is None:
+        return None
+
+    dm, schema = path_index.load_dm(dm_filename)
+    if not any("." in path and isinstance(access, str) for path, access in dm.items()):
+        raise ValueError("[{}] has no (parameter path -> access) entries, use a flat Implemented Data Model "
+                         "such as the output of access_map.py".format(dm_filename))
+
+    return schema
+
+
+def _check_valid_params(counts, dm_filename):
+    """Raise ValueError if the Implemented Data Model dropped every parameter"""
+    if counts["parameters"] and counts["invalid"] == counts["parameters"]:
+        raise ValueError("None of the {} parameters is in the Implemented Data Model [{}]".format(
+            counts["parameters"], dm_filename))
+
+
+def _filter_params(params, schema, counts):
+    """Keep the parameters that the Implemented Data Model implements, counting the others"""
+    counts["parameters"] += len(params)
+    if schema is None:
+        return params
+
+    valid_params = {name: value for name, value in params.items()
+                    if schema.is_param(utils.PathHelper.generic_dm_path(name))}
+    counts["invalid"] += len(params) - len(valid_params)
+    return valid_params
+
+
+def ingest_file(result_filename, schema=None):
+    """Flatten, type and validate a single WebPA result file, returning (params, counts)"""
+    counts = {"parameters": 0, "invalid": 0}
+
+    with open(result_filename, "rb") as result_file:
+        chunks = iter(functools.partial(result_file.read, INGEST_CHUNK_SIZE), b"")
+        params = webpa_response.decode_batch(webpa_response.iter_parameters(chunks))
+
+    return _filter_params(params, schema, counts), counts
+
+
+def ingest_lines(lines, schema=None):
+    """Flatten, type and validate NDJSON WebPA results (one response per line), returning (params, counts)"""
+    db = {}
+    counts = {"parameters": 0, "invalid": 0}
+
+    for line_number, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                params = webpa_response.decode_batch(webpa_response.iter_parameters([line]))
+            except ValueError as parse_err:
+                raise ValueError("Line {}: {}".format(line_number, parse_err)) from parse_err
+            db.update(_filter_params(params, schema, counts))
+
+    return db, counts
+
+
+def _init_worker(dm_filename):
+    """Build the SchemaIndex once per pool worker process"""
+    global _worker_schema
+    _worker_schema = load_schema(dm_filename)
+
+
+def _ingest_file_in_worker(result_filename):
+    """Ingest a result file within a pool worker process"""
+    return ingest_file(result_filename, _worker_schema)
+
+
+def write_db(db, db_filename):
+    """Write the DB file, replacing the previous one atomically"""
+    tmp_filename = db_filename + ".tmp"
+    with open(tmp_filename, "w") as db_file:
+        json.dump(db, db_file, cls=utils.TypedValueEncoder)
+    os.replace(tmp_filename, db_filename)
+
+
+def ingest_files(result_filenames, db_filename, dm_filename=None, workers=None):
+    """Ingest the result files in parallel and write the merged DB file, returning the run's counts
+
+    Raises ValueError, without writing the DB file, if the Implemented Data Model has no parameters
+    or none of the ingested parameters is in it
+    """
+    db = {}
+    summary = {"files": 0, "parameters": 0, "invalid": 0, "errors": 0}
+
+    # Checked before the pool starts, each worker then loads it from the schema cache
+    load_schema(dm_filename)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                initargs=(dm_filename,)) as executor:
+        futures = [executor.submit(_ingest_file_in_worker, result_filename) for result_filename in result_filenames]
+
+        # Merged in the order given, so that later files win
+        for result_filename, future in zip(result_filenames, futures):
+            try:
+                params, counts = future.result()
+            except (OSError, ValueError) as ingest_err:
+                summary["errors"] += 1
+                sys.stderr.write("Unable to ingest [{}]: {}\n".format(result_filename, ingest_err))
+                continue
+
+            db.update(params)
+            summary["files"] += 1
+            summary["parameters"] += counts["parameters"]
+            summary["invalid"] += counts["invalid"]
+
+    _check_valid_params(summary, dm_filename)
+    write_db(db, db_filename)
+    summary["entries"] = len(db)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert captured WebPA results into a DB file")
+    parser.add_argument("result_files", nargs="*", help="WebPA result files (default: NDJSON from stdin)")
+    parser.add_argument("--dm", default=None, help="Implemented Data Model to validate the parameters against")
+    parser.add_argument("--output", default="erdk-db.json", help="DB file to write")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+
+    try:
+        if args.result_files:
+            summary = ingest_files(args.result_files, args.output, args.dm, args.workers)
+        else:
+            db, summary = ingest_lines(sys.stdin, load_schema(args.dm))
+            _check_valid_params(summary, args.dm)
+            write_db(db, args.output)
+            summary["entries"] = len(db)
+    except ValueError as ingest_err:
+        sys.exit("Not writing [{}]: {}".format(args.output, ingest_err))
+
+    sys.stderr.write(json.dumps(summary) + "\n")
+
+
+if __name__ == "__main__":
+    main()
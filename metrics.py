@@ -0,0 +1,131 @@
+"""
+# File Name: metrics.py
+#
+# Description: Prometheus Instrumentation shared by the Database implementations
+#
+# Functionality:
+#  - Histograms of Database operation processing time and result size
+#    (database_processing_seconds replaces the per-operation database_<operation>_processing_seconds
+#    Summaries, which agent_db.py still exports, unchanged, until dashboards and alerts have moved:
+#    rate(database_get_processing_seconds_sum[5m]) becomes
+#    rate(database_processing_seconds_sum{database="agent_db",operation="get"}[5m]), same for _count)
+#  - Counter of Database operation errors (NoSuchPathError, ...)
+#  - Histogram of WebPA round-trip time
+#  - Counter of Device Twins collected by fleet runs (success/partial/failure)
+#  - Counters of cache hits/stale hits/misses/coalesced misses, plus the hits/misses of the utils.PathHelper LRU caches
+#  - Labels are limited to fixed sets (database, operation, cache, result, status, error type),
+#    never parameter paths or MAC addresses, so that the number of series stays bounded
+#
+#   Function: instrument(database, operation, result_size=False)
+#   Function: observe_webpa_request(status, seconds)
+#   Function: count_cache_request(cache, result)
+#   Function: count_fleet_twin(result)
+#
+"""
+
+import time
+import functools
+import prometheus_client
+from prometheus_client.core import CounterMetricFamily
+
+import utils
+
+
+PROCESSING_TIME_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5,
+                           float("inf"))
+RESULT_SIZE_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, float("inf"))
+WEBPA_TIME_BUCKETS = (.01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+# pylint: disable-msg=no-value-for-parameter
+DB_PROCESSING_TIME_METRIC = \
+    prometheus_client.Histogram("database_processing_seconds",
+                                "Time spent handling a Database Call",
+                                ["database", "operation"], buckets=PROCESSING_TIME_BUCKETS)
+# pylint: disable-msg=no-value-for-parameter
+DB_RESULT_SIZE_METRIC = \
+    prometheus_client.Histogram("database_result_size",
+                                "Number of entries returned by a Database Call",
+                                ["database", "operation"], buckets=RESULT_SIZE_BUCKETS)
+# pylint: disable-msg=no-value-for-parameter
+DB_ERROR_METRIC = \
+    prometheus_client.Counter("database_errors",
+                              "Number of Database Calls that raised an error",
+                              ["database", "operation", "error"])
+# pylint: disable-msg=no-value-for-parameter
+WEBPA_REQUEST_TIME_METRIC = \
+    prometheus_client.Histogram("webpa_request_seconds",
+                                "Time spent waiting on a WebPA request",
+                                ["status"], buckets=WEBPA_TIME_BUCKETS)
+# pylint: disable-msg=no-value-for-parameter
+CACHE_REQUEST_METRIC = \
+    prometheus_client.Counter("cache_requests",
+                              "Number of cache lookups",
+                              ["cache", "result"])
+# pylint: disable-msg=no-value-for-parameter
+FLEET_TWIN_METRIC = \
+    prometheus_client.Counter("fleet_twins",
+                              "Number of Device Twins collected by fleet runs",
+                              ["result"])
+
+
+def instrument(database, operation, result_size=False):
+    """Decorate a Database method to record its processing time, errors and (optionally) result size"""
+    processing_time = DB_PROCESSING_TIME_METRIC.labels(database, operation)
+    result_size_metric = DB_RESULT_SIZE_METRIC.labels(database, operation)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as err:
+                DB_ERROR_METRIC.labels(database, operation, type(err).__name__).inc()
+                raise
+            finally:
+                processing_time.observe(time.perf_counter() - start)
+
+            if result_size and result is not None:
+                result_size_metric.observe(len(result))
+            return result
+        return wrapper
+    return decorator
+
+
+def observe_webpa_request(status, seconds):
+    """Record the round-trip time of a WebPA request, status is the HTTP status code or "error\""""
+    WEBPA_REQUEST_TIME_METRIC.labels(str(status)).observe(seconds)
+
+
+def count_cache_request(cache, result):
+    """Record a lookup of the named cache, result is "hit", "stale", "miss" or "coalesced" (waited on another miss)"""
+    CACHE_REQUEST_METRIC.labels(cache, result).inc()
+
+
+def count_fleet_twin(result):
+    """Record a Device Twin collected by a fleet run, result is "success", "partial" or "failure\""""
+    FLEET_TWIN_METRIC.labels(result).inc()
+
+
+class LruCacheCollector:
+    """Exposes the hits/misses of functools.lru_cache functions as cache_requests"""
+    def __init__(self, caches):
+        """Initialize the Collector with a map of cache name to lru_cache function"""
+        self._caches = caches
+
+    def collect(self):
+        """Retrieve the current hit/miss counts"""
+        family = CounterMetricFamily("lru_cache_requests", "Number of lookups of in-process LRU caches",
+                                     labels=["cache", "result"])
+        for name, cached_func in self._caches.items():
+            cache_info = cached_func.cache_info()
+            family.add_metric([name, "hit"], cache_info.hits)
+            family.add_metric([name, "miss"], cache_info.misses)
+        yield family
+
+
+prometheus_client.REGISTRY.register(LruCacheCollector({
+    "generic_dm_path": utils.PathHelper.generic_dm_path,
+    "dm_regex": utils.PathHelper.dm_regex,
+    "db_regex": utils.PathHelper.db_regex,
+}))
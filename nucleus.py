@@ -35,78 +35,111 @@ SOFTWARE.
 #  --- find_instances: find multi-object instance partial paths
 #  --- find_impl_objects: find implemented object partial paths
 #  - Save command (saves the contents of the database back to a file)
+#  - Values are retrieved from WebPA over a pooled, shared connection (see webpa.py)
+#  - Device Twin subtrees are retrieved with concurrent WebPA queries (get_concurrent), each one
+#    timed from when it is sent, all of them within an overall deadline
+#  - Device Twins are cached in memory per MAC (see twin_cache.py), an expired twin is served
+#    while it is refreshed in the background until TWIN_CACHE_HARD_TTL
+#  - Each Device Twin subtree has its own freshness (SUBTREE_MAX_AGE), only stale subtrees are
+#    re-retrieved and UpTime is derived locally from its last sample; a stale subtree that can't
+#    be refreshed is reported as failed rather than served from its old sample, and a device
+#    that none of the stale subtrees can be refreshed from is not served at all
 #
 """
 
-import re
-import json
 import os
 import time
 import logging
 import datetime
-#import prometheus_client
+import prometheus_client
 import requests
 from dotenv import load_dotenv
-import operator
-import functools
-from collections import defaultdict
+import concurrent.futures
 import datetime
 import pprint
-from cachier import cachier
 import datetime
+import utils
+import metrics
+import path_index
+import webpa
+import webpa_response
+import twin_cache
 
 
 load_dotenv()
 
-from flask import Flask, render_template
+from flask import Flask, Response, render_template
 
 app = Flask(__name__)
 
 
-# pylint: disable-msg=no-value-for-parameter
-"""
-DB_GET_SUMMARY_METRIC = \
-    prometheus_client.Summary("database_get_processing_seconds",
-                              "Time spent handling Database Get Call")
-# pylint: disable-msg=no-value-for-parameter
-DB_UPDATE_SUMMARY_METRIC = \
-    prometheus_client.Summary("database_update_processing_seconds",
-                              "Time spent handling Database Update Call")
-# pylint: disable-msg=no-value-for-parameter
-DB_INSERT_SUMMARY_METRIC = \
-    prometheus_client.Summary("database_insert_processing_seconds",
-                              "Time spent handling Database Insert Call")
-# pylint: disable-msg=no-value-for-parameter
-DB_DELETE_SUMMARY_METRIC = \
-    prometheus_client.Summary("database_delete_processing_seconds",
-                              "Time spent handling Database Delete Call")
-# pylint: disable-msg=no-value-for-parameter
-DB_FIND_PARAMS_SUMMARY_METRIC = \
-    prometheus_client.Summary("database_find_params_processing_seconds",
-                              "Time spent handling Database FindParams Call")
-# pylint: disable-msg=no-value-for-parameter
-DB_FIND_INSTANCES_SUMMARY_METRIC = \
-    prometheus_client.Summary("database_find_instances_processing_seconds",
-                              "Time spent handling Database FindInstances Call")
-# pylint: disable-msg=no-value-for-parameter
-DB_FIND_OBJECTS_SUMMARY_METRIC = \
-    prometheus_client.Summary("database_find_objects_processing_seconds",
-                              "Time spent handling Database FindObjects Call")
-# pylint: disable-msg=no-value-for-parameter
-DB_FIND_IMPL_OBJECTS_SUMMARY_METRIC = \
-    prometheus_client.Summary("database_find_impl_objects_processing_seconds",
-                              "Time spent handling Database FindImplObjects Call")
-"""
+# The DeviceInfo parameters of a Device Twin, they share one freshness and are retrieved with one query
+DEVICE_INFO_PARAMS = [
+    'Device.DeviceInfo.X_COMCAST-COM_CM_MAC',
+    'Device.DeviceInfo.X_CISCO_COM_BootloaderVersion',
+    'Device.DeviceInfo.X_CISCO_COM_FirmwareName',
+    'Device.DeviceInfo.X_CISCO_COM_FirmwareBuildTime',
+    'Device.DeviceInfo.Hardware',
+    'Device.DeviceInfo.Manufacturer',
+    'Device.DeviceInfo.ModelName',
+    'Device.DeviceInfo.Description',
+    'Device.DeviceInfo.ProductClass',
+    'Device.DeviceInfo.SerialNumber',
+    'Device.DeviceInfo.HardwareVersion',
+    'Device.DeviceInfo.SoftwareVersion',
+    'Device.DeviceInfo.UpTime',
+]
+
+# The subtrees that make up a Device Twin, each one is retrieved with its own query (names=...)
+DEVICE_TWIN_PATHS = [
+    ','.join(DEVICE_INFO_PARAMS),
+    'Device.Bridging.Bridge.',
+    'Device.Ethernet.',
+    'Device.WiFi.',
+    'Device.Hosts.',
+]
+
+# Seconds that each query waits on WebPA (connect, then between bytes of the response) when the
+#  subtrees are retrieved concurrently, counted from when the query is sent
+WEBPA_QUERY_TIMEOUT = 10.0
+# Seconds that a concurrent retrieval waits on all of its queries, including their time queued
+WEBPA_FAN_OUT_DEADLINE = 30.0
+
+# Seconds that a sample of a subtree stays fresh, the longest matching path prefix applies
+SUBTREE_MAX_AGE = {
+    'Device.DeviceInfo.': 3600,
+    'Device.Bridging.Bridge.': 60,
+    'Device.Ethernet.': 10,
+    'Device.WiFi.': 10,
+    'Device.Hosts.': 10,
+}
+DEFAULT_SUBTREE_MAX_AGE = 0
+
+# Parameters whose value is derived locally from the last sample (sampled value + seconds since the sample)
+DERIVED_UPTIME_PATHS = ('Device.DeviceInfo.UpTime',)
+
+
+def get_subtree_max_age(path):
+    """Retrieve the number of seconds that a sample of the subtree stays fresh"""
+    max_age = DEFAULT_SUBTREE_MAX_AGE
+    prefix_len = -1
+    for prefix, prefix_max_age in SUBTREE_MAX_AGE.items():
+        if path.startswith(prefix) and len(prefix) > prefix_len:
+            max_age = prefix_max_age
+            prefix_len = len(prefix)
+
+    return max_age
 
 
 class Database:
 
     """Represents a simple database"""
-    def __init__(self, dm_filename, base_url, creds, debug=False):
+    def __init__(self, dm_filename, base_url, creds, debug=False, client=None):
         """Initialize the DB from a file"""
         self._start_time = time.time()
         self._base_url = base_url
         self._creds = creds
+        self._client = client if client is not None else webpa.get_client(base_url, creds)
         self._db = {}
 
         if debug:
@@ -115,48 +148,32 @@ class Database:
         self._log.debug("Initializing the Database...")
 
         # Retrieve the Implemented Data Model
-        with open(dm_filename, "r") as dm_in_json:
-            try:
-                self._dm = json.load(dm_in_json)
-            except ValueError as parse_err:
-                self._dm = {}
-                self._log.error("Implemented Data Model is NOT properly formatted JSON: %s", parse_err)
+        try:
+            self._dm = path_index.open_access_map(dm_filename)
+        except ValueError as parse_err:
+            self._dm = {}
+            self._log.error("Implemented Data Model is NOT properly formatted JSON: %s", parse_err)
 
         #Load DB
         self.reset()
 
     def _process_webpa_resp(self, webpa_parameters):
-        result = {}
-
-        for parameter in webpa_parameters:
-            if parameter['parameterCount'] > 1:
-                for entry in parameter['value']:
-                    if entry['dataType'] == 2:
-                        #print("%s:%d" % (entry['name'], int(entry['value'])))
-                        result[entry['name']]= int(entry['value'])
-                    else:
-                        if entry['value'] == "":
-                            result[entry['name']]= ""
-                        else:
-                            #print("%s:%s" % (entry['name'], entry['value']))
-                            result[entry['name']]= entry['value']
-            else:
-                if parameter['dataType'] == 2:
-                    #print("%s:%d" % (entry['name'], int(entry['value'])))
-                    result[parameter['name']]= int(parameter['value'])
-                else:
-                    if parameter['value'] == "":
-                        result[parameter['name']]= ""
-                    else:
-                        #print("%s:%s" % (entry['name'], entry['value']))
-                        result[parameter['name']]= parameter['value']
-        return result
-
-    def _get_webpa(self, mac, paths):
-       r = requests.get(self._base_url +"mac:"+ mac +"/config?names="+ paths, headers={'Authorization':'Basic '+self._creds})
+        """Build the (name -> typed value) result from the streamed (name, value, dataType) parameters"""
+        return webpa_response.decode_batch(webpa_parameters)
+
+    def _get_webpa(self, mac, paths, timeout=None, retry_reads=True):
+       start = time.perf_counter()
+       try:
+          r = self._client.get_config(mac, paths, timeout, stream=True, retry_reads=retry_reads)
+       except requests.RequestException:
+          metrics.observe_webpa_request("error", time.perf_counter() - start)
+          raise
+       metrics.observe_webpa_request(r.status_code, time.perf_counter() - start)
        #print(name, r.text)
        if r.status_code == 200:
-          return self._process_webpa_resp(r.json()['parameters'])
+          # Parsed as the body arrives, the whole response is never held in memory
+          with r:
+             return self._process_webpa_resp(webpa_response.iter_response(r))
        elif r.status_code == 520:
           print(r.status_code, r.text, paths)
           return []
@@ -164,12 +181,12 @@ class Database:
           print(r.status_code, r.text, paths)
           return None
 
-    #@DB_GET_SUMMARY_METRIC.time()
-    def get(self, mac, paths):
+    @metrics.instrument("nucleus", "get", result_size=True)
+    def get(self, mac, paths, timeout=None, retry_reads=True):
         """Retrieve the value of the incoming path, or throw a NoSuchPathError"""
         value = None
 
-        value = self._get_webpa(mac, paths)
+        value = self._get_webpa(mac, paths, timeout, retry_reads)
 
         # when there are multiple paths, the server doesn't tell you which one failed
         if value == None:
@@ -187,12 +204,58 @@ class Database:
 
         return value
 
+    @metrics.instrument("nucleus", "get_concurrent")
+    def get_concurrent(self, mac, path_list, timeout=WEBPA_QUERY_TIMEOUT, deadline=WEBPA_FAN_OUT_DEADLINE,
+                       executor=None):
+        """Retrieve each of the incoming paths with its own concurrent WebPA query
+
+        timeout applies to each query from when it is sent (reads aren't retried), deadline to the
+        whole retrieval including the time that queries wait for a worker. The queries run on executor
+        (default: the shared webpa.get_executor()), whose workers bound the WebPA requests in flight.
+        Returns the (path -> values) of the queries that succeeded, in the order of path_list, and the
+        (path -> reason) of the queries that failed, timed out or didn't complete before the deadline
+        """
+        results = {}
+        failed = {}
+        if executor is None:
+            executor = webpa.get_executor()
+        futures = {executor.submit(self.get, mac, path, timeout, False): path for path in path_list}
+
+        def collect(future):
+            path = futures[future]
+            try:
+                results[path] = future.result()
+            except NoSuchPathError:
+                failed[path] = "no such path"
+            except requests.Timeout:
+                failed[path] = "timeout"
+            except (requests.RequestException, ValueError) as req_err:
+                # ValueError: the response was not properly formatted JSON
+                failed[path] = type(req_err).__name__
+
+        try:
+            for future in concurrent.futures.as_completed(futures, timeout=deadline):
+                collect(future)
+        except concurrent.futures.TimeoutError:
+            for future, path in futures.items():
+                if path in results or path in failed:
+                    continue
+                if future.done():
+                    # Completed since the deadline passed
+                    collect(future)
+                else:
+                    # A query that is still queued never gets sent, one in progress ends within its timeout
+                    future.cancel()
+                    failed[path] = "deadline exceeded"
+
+        if failed:
+            self._log.warning("get_concurrent: Unable to retrieve %s from [%s]", failed, mac)
+
+        return {path: results[path] for path in path_list if path in results}, failed
+
     def _generic_dm_path(self, path):
         """Turn a DM Path into a Generic one by replacing instance numbers and wildcards"""
-        generic_path = re.sub(r'\.[0-9]+\.', r'.{i}.', path)  # Instance Number Addressing
-        generic_path = re.sub(r'\.\*\.', r'.{i}.', generic_path)  # Wild-card Searching
-
-        return generic_path
+        return utils.PathHelper.generic_dm_path(path)
 
     def _update(self, path, value):
         dm_param_path = self._generic_dm_path(path)
@@ -204,7 +267,7 @@ class Database:
         else:
             raise NoSuchPathError(path)
 
-    #@DB_UPDATE_SUMMARY_METRIC.time()
+    @metrics.instrument("nucleus", "update")
     def update(self, path, value):
         """Change the value of the incoming path, or throw a NoSuchPathError"""
         if self.is_param_writable(path):
@@ -245,96 +308,141 @@ class NoSuchPathError(Exception):
         return repr(self.value)
 
 class NucleusDevice(object):
-    def __init__(self, base_url, creds, mac):
+    def __init__(self, base_url, creds, mac, fan_out=True, timeout=WEBPA_QUERY_TIMEOUT, samples=None,
+                 deadline=WEBPA_FAN_OUT_DEADLINE, executor=None):
         self._mac = mac
         self._db = Database("erdk-dm.json", base_url, creds, None)
+        self._fan_out = fan_out
+        self._timeout = timeout
+        self._deadline = deadline
+        self._executor = executor
+        self._samples = samples if samples is not None else device_subtree_cache
+        self.failed_paths = {}
 
     def get(self):
-        def dd_to_dict(d):
-            if isinstance(d, defaultdict):
-                d = {k: dd_to_dict(v) for k, v in d.items()}
-            return d
-
-        def get_path(paths, master_dict):
-
-            query_result = self._db.get(self._mac, paths)
-
-            for entry in query_result:
-                keys = entry.split('.')
-                lastplace = functools.reduce(operator.getitem, keys[:-1], master_dict)
-                lastplace[keys[-1]] = query_result[entry]
-            return master_dict
-
-        dict_result = {}
-
-        infinitedict = lambda: defaultdict(infinitedict)
-        dict_result = infinitedict()
-
-        """
-        for path in ['Device.DeviceInfo.X_COMCAST-COM_CM_MAC', 
-                'Device.DeviceInfo.X_CISCO_COM_BootloaderVersion',
-                'Device.DeviceInfo.X_CISCO_COM_FirmwareName',
-                'Device.DeviceInfo.X_CISCO_COM_FirmwareBuildTime',
-                'Device.DeviceInfo.Hardware',
-                'Device.DeviceInfo.Manufacturer',
-                'Device.DeviceInfo.ModelName',
-                'Device.DeviceInfo.Description',
-                'Device.DeviceInfo.ProductClass',
-                'Device.DeviceInfo.SerialNumber',
-                'Device.DeviceInfo.HardwareVersion',
-                'Device.DeviceInfo.SoftwareVersion',
-                'Device.DeviceInfo.UpTime',
-                'Device.Bridging.Bridge.',
-                'Device.Ethernet.',
-                'Device.WiFi.',
-                'Device.Hosts.',
-                #'Device.DeviceInfo.X_RDKCENTRAL-COM_xOpsDeviceMgmt.Mesh.',
-                #"Device.WiFi.AccessPoint."]:
-                ]:
-            dict_result = get_path(path, dict_result)
-        """
-        #paths = ','.join(['Device.DeviceInfo.X_COMCAST-COM_CM_MAC','Device.DeviceInfo.X_CISCO_COM_BootloaderVersion'])
-        paths =','.join(['Device.DeviceInfo.X_COMCAST-COM_CM_MAC', 
-                'Device.DeviceInfo.X_CISCO_COM_BootloaderVersion',
-                'Device.DeviceInfo.X_CISCO_COM_FirmwareName',
-                'Device.DeviceInfo.X_CISCO_COM_FirmwareBuildTime',
-                'Device.DeviceInfo.Hardware',
-                'Device.DeviceInfo.Manufacturer',
-                'Device.DeviceInfo.ModelName',
-                'Device.DeviceInfo.Description',
-                'Device.DeviceInfo.ProductClass',
-                'Device.DeviceInfo.SerialNumber',
-                'Device.DeviceInfo.HardwareVersion',
-                'Device.DeviceInfo.SoftwareVersion',
-                'Device.DeviceInfo.UpTime',
-                'Device.Bridging.Bridge.',
-                'Device.Ethernet.',
-                'Device.WiFi.',
-                'Device.Hosts.'])
-
-        dict_result = get_path(paths, dict_result)
-
-        return str(json.dumps(dd_to_dict(dict_result)))
+        flat_result = {}
+
+        # Only the subtrees whose last sample is stale are retrieved from WebPA
+        stale_paths = self._samples.get_stale_paths(self._mac, DEVICE_TWIN_PATHS, get_subtree_max_age)
+        refreshed = {}
+        self.failed_paths = {}
+
+        if stale_paths:
+            if self._fan_out:
+                # One query per subtree, so that a slow subtree only delays itself and a failure
+                #  can be attributed to the path that caused it
+                results, self.failed_paths = self._db.get_concurrent(
+                    self._mac, stale_paths, self._timeout, self._deadline, self._executor)
+            else:
+                # when there are multiple paths, the server doesn't tell you which one failed
+                results = self._split_by_subtree(self._db.get(self._mac, ','.join(stale_paths)), stale_paths)
+
+            # An empty result (device not reachable) isn't kept as a sample
+            refreshed = {path: values for path, values in results.items() if values}
+            self._samples.update(self._mac, refreshed)
+            for path in stale_paths:
+                if path not in refreshed:
+                    self.failed_paths.setdefault(path, "no values")
+
+            if not refreshed:
+                # Not a single subtree could be refreshed, the device isn't served from its old samples
+                raise NoSuchPathError(list(self.failed_paths))
+
+        found = False
+        for path in DEVICE_TWIN_PATHS:
+            if path in self.failed_paths:
+                # A stale subtree that couldn't be refreshed is failed, not served
+                continue
+            elif path in refreshed:
+                values = refreshed[path]
+            else:
+                sample = self._samples.get_sample(self._mac, path)
+                if sample is None:
+                    continue
+                sample_age, values = sample
+                values = self._derive_uptime(values, sample_age)
+
+            found = True
+            flat_result.update(values)
+
+        if not found:
+            raise NoSuchPathError(list(self.failed_paths))
+
+        return utils.TreeHelper.to_json(flat_result)
+
+    @staticmethod
+    def _split_by_subtree(query_result, paths):
+        """Split the result of a multi-path query into the (path -> values) of each subtree"""
+        results = {path: {} for path in paths}
+        names = [(name, path) for path in paths for name in path.split(',')]
+        for entry in query_result:
+            for name, path in names:
+                if entry == name or (name.endswith('.') and entry.startswith(name)):
+                    results[path][entry] = query_result[entry]
+                    break
+
+        return results
+
+    @staticmethod
+    def _derive_uptime(values, sample_age):
+        """Advance the sampled UpTime values (DERIVED_UPTIME_PATHS) by the age of the sample"""
+        derived = {}
+        for name, value in values.items():
+            derived[name] = value
+            if name in DERIVED_UPTIME_PATHS:
+                try:
+                    derived[name] = int(value) + int(sample_age)
+                except ValueError:
+                    pass
+
+        return derived
 
     def __repr__(self):
         return 'device_'+self._mac
 
-@cachier(stale_after=datetime.timedelta(seconds=10))
+device_twin_cache = twin_cache.TwinCache("device_twin",
+                                         float(os.getenv("TWIN_CACHE_TTL", twin_cache.TWIN_CACHE_TTL)),
+                                         int(os.getenv("TWIN_CACHE_MAX_SIZE", twin_cache.TWIN_CACHE_MAX_SIZE)),
+                                         float(os.getenv("TWIN_CACHE_HARD_TTL", twin_cache.TWIN_CACHE_HARD_TTL)))
+
+device_subtree_cache = twin_cache.SubtreeCache(int(os.getenv("SUBTREE_CACHE_MAX_SIZE",
+                                                                twin_cache.SUBTREE_CACHE_MAX_SIZE)),
+                                               float(os.getenv("SUBTREE_CACHE_HARD_MAX_AGE",
+                                                               twin_cache.SUBTREE_CACHE_HARD_MAX_AGE)))
+
 def get_device_twin(base_url, creds, mac):
     nd = NucleusDevice(base_url, creds, mac)
     return nd.get()
 
+def get_cached_device_twin(base_url, creds, mac):
+    return device_twin_cache.get(mac, lambda: get_device_twin(base_url, creds, mac))
+
+@app.route('/metrics')
+def get_metrics():
+    return Response(prometheus_client.generate_latest(), mimetype=prometheus_client.CONTENT_TYPE_LATEST)
+
 @app.route('/device/<mac>')
 def get_device_info(mac):
     creds = os.getenv("TOKEN")
     base_url = os.getenv("BASE_URL")
     try:
-        get_device_twin.clear_cache()
-        result = get_device_twin(base_url, creds, mac)
+        result = get_cached_device_twin(base_url, creds, mac)
     except:
         return {'message':'ERROR:  Device does not exist'}
     return result
 
+@app.route('/cache/device/<mac>', methods=['DELETE'])
+def invalidate_device_info(mac):
+    invalidated = device_twin_cache.invalidate(mac)
+    invalidated = device_subtree_cache.invalidate(mac) or invalidated
+    return {'invalidated': invalidated}
+
+@app.route('/cache/device', methods=['DELETE'])
+def invalidate_all_device_info():
+    device_twin_cache.clear()
+    device_subtree_cache.clear()
+    return {'invalidated': True}
+
 def main():
     creds = os.getenv("TOKEN")
     base_url = os.getenv("BASE_URL")
@@ -343,7 +451,6 @@ def main():
     mac="b827eb112233"
     #mac="000000000001"
 
-    get_device_twin.clear_cache()
     print(get_device_twin(base_url, creds, mac))
 
 if __name__ == "__main__":
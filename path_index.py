@@ -0,0 +1,376 @@
+"""
+# File Name: path_index.py
+#
+# Description: Indexes for Parameter Paths and the Implemented Data Model
+#
+# Functionality:
+#   Class: PathTrie(object)
+#    - __init__(paths=None)
+#    - add(path) / remove(path)
+#    - match(path_parts): resolve (possibly wild-carded) path parts to trie nodes
+#    - static: iter_paths(node, prefix): walk every path stored below a node
+#    - static: split_path(path)
+#   Class: InstanceIndex(object)
+#    - __init__(paths=None)
+#    - add(path) / remove(path)
+#    - get_instances(table_path) / get_count(table_path)
+#   Class: SchemaIndex(object)
+#    - __init__(dm)
+#    - is_param(generic_path) / is_object(generic_path) / is_table(generic_path)
+#    - get_access(generic_path)
+#    - get_child_objects(generic_path) / get_param_objects(generic_path)
+#   Class: SortedAccessMap(Mapping)
+#    - __init__(filename): a sorted access map file (tab-separated "generic parameter path, access" lines)
+#    - read-only Mapping (generic parameter path -> access), binary searched within the mmap'd file
+#   Function: load_dm(dm_filename): (dm, SchemaIndex), compiled once (see schema_cache.py)
+#   Function: open_access_map(dm_filename): (generic parameter path -> access) without indexing it
+#
+"""
+
+import os
+import json
+import mmap
+import collections.abc
+
+import schema_cache
+
+
+# Implemented Data Model files with this suffix are sorted access maps instead of JSON (see access_map.py)
+SORTED_ACCESS_MAP_SUFFIX = ".tsv"
+
+
+class PathNode:
+    """A single path segment within a PathTrie"""
+    __slots__ = ("children", "is_path")
+
+    def __init__(self):
+        """Initialize the PathNode"""
+        self.children = {}
+        self.is_path = False
+
+
+class PathTrie:
+    """A Trie keyed on the dot-separated parts of a Parameter Path"""
+    def __init__(self, paths=None):
+        """Initialize the PathTrie, optionally from an iterable of paths"""
+        self._root = PathNode()
+        self._count = 0
+
+        if paths is not None:
+            for path in paths:
+                self.add(path)
+
+    def __len__(self):
+        """Return the number of paths stored in the PathTrie"""
+        return self._count
+
+    def __contains__(self, path):
+        """Determine if the full path is stored in the PathTrie"""
+        node = self._find_node(path.split("."))
+        return node is not None and node.is_path
+
+    def add(self, path):
+        """Add a full path to the PathTrie, return True if it was not already present"""
+        node = self._root
+        for part in path.split("."):
+            child = node.children.get(part)
+            if child is None:
+                child = PathNode()
+                node.children[part] = child
+            node = child
+
+        if node.is_path:
+            return False
+
+        node.is_path = True
+        self._count += 1
+        return True
+
+    def remove(self, path):
+        """Remove a full path from the PathTrie, pruning any segments left empty"""
+        trail = []
+        node = self._root
+        for part in path.split("."):
+            child = node.children.get(part)
+            if child is None:
+                return False
+            trail.append((node, part))
+            node = child
+
+        if not node.is_path:
+            return False
+
+        node.is_path = False
+        self._count -= 1
+
+        # Prune the segments that no longer lead to a stored path
+        while trail and not node.is_path and not node.children:
+            parent, part = trail.pop()
+            del parent.children[part]
+            node = parent
+
+        return True
+
+    def match(self, path_parts):
+        """Retrieve the (path prefix, node) pairs that the incoming path parts resolve to
+
+        A "*" part matches any instance number segment, every other part must match exactly
+        """
+        nodes = [("", self._root)]
+
+        for part in path_parts:
+            next_nodes = []
+            for prefix, node in nodes:
+                if part == "*":
+                    for child_part, child in node.children.items():
+                        if child_part.isdigit():
+                            next_nodes.append((prefix + child_part + ".", child))
+                else:
+                    child = node.children.get(part)
+                    if child is not None:
+                        next_nodes.append((prefix + part + ".", child))
+
+            nodes = next_nodes
+            if not nodes:
+                break
+
+        return nodes
+
+    @staticmethod
+    def iter_paths(node, prefix):
+        """Yield the full paths stored below the node, prefix is the node's path (with trailing '.')"""
+        stack = [(prefix, iter(node.children.items()))]
+
+        while stack:
+            child_prefix, children = stack[-1]
+            for child_part, child in children:
+                if child.is_path:
+                    yield child_prefix + child_part
+                if child.children:
+                    stack.append((child_prefix + child_part + ".", iter(child.children.items())))
+                    break
+            else:
+                stack.pop()
+
+    @staticmethod
+    def split_path(path):
+        """Split a path into its parts, ignoring the trailing '.' of a partial path"""
+        path_parts = path.split(".")
+        if path.endswith("."):
+            path_parts.pop()
+
+        return path_parts
+
+    def _find_node(self, path_parts):
+        """Retrieve the node for the exact path parts, or None"""
+        node = self._root
+        for part in path_parts:
+            node = node.children.get(part)
+            if node is None:
+                break
+
+        return node
+
+
+class InstanceIndex:
+    """The instance numbers of every instantiated table, kept up to date as paths are added and removed"""
+    def __init__(self, paths=None):
+        """Initialize the InstanceIndex, optionally from an iterable of paths"""
+        # table path (with trailing '.') -> {instance number: number of paths within that instance}
+        self._tables = {}
+
+        if paths is not None:
+            for path in paths:
+                self.add(path)
+
+    def add(self, path):
+        """Count a newly added path against the table instances it is within"""
+        for table_path, inst_num in self._iter_instances(path):
+            instances = self._tables.setdefault(table_path, {})
+            instances[inst_num] = instances.get(inst_num, 0) + 1
+
+    def remove(self, path):
+        """Stop counting a removed path, dropping any table instance that has no paths left"""
+        for table_path, inst_num in self._iter_instances(path):
+            instances = self._tables[table_path]
+            instances[inst_num] -= 1
+            if not instances[inst_num]:
+                del instances[inst_num]
+                if not instances:
+                    del self._tables[table_path]
+
+    def get_instances(self, table_path):
+        """Retrieve the instance numbers of the table path (with trailing '.')"""
+        return list(self._tables.get(table_path, ()))
+
+    def get_count(self, table_path):
+        """Retrieve the number of instances of the table path (with trailing '.')"""
+        return len(self._tables.get(table_path, ()))
+
+    @staticmethod
+    def _iter_instances(path):
+        """Yield the (table path, instance number) pairs that the path is within"""
+        table_path = ""
+        for part in path.split(".")[:-1]:
+            if part.isdigit() and table_path:
+                yield table_path, part
+            table_path += part + "."
+
+
+class SchemaIndex:
+    """A precomputed Index of the Implemented Data Model (generic parameter path -> access)"""
+    def __init__(self, dm):
+        """Initialize the SchemaIndex from the Implemented Data Model"""
+        self._access = {}
+        self._objects = {}
+        self._tables = set()
+        self._child_objects = {}
+        self._param_objects = {}
+
+        for dm_key, access in dm.items():
+            self._access[dm_key] = access
+            key_parts = dm_key.split(".")
+            param_obj_path = ".".join(key_parts[:-1]) + "."
+
+            obj_path = ""
+            for inx, part in enumerate(key_parts[:-1]):
+                parent_obj_path = obj_path
+                obj_path += part + "."
+                self._objects.setdefault(obj_path, None)
+                self._param_objects.setdefault(obj_path, {})[param_obj_path] = None
+
+                if parent_obj_path:
+                    self._child_objects.setdefault(parent_obj_path, {})[obj_path] = None
+
+                if key_parts[inx + 1] == "{i}":
+                    self._tables.add(obj_path)
+
+    def is_param(self, generic_path):
+        """Determine if the generic path is an implemented parameter"""
+        return generic_path in self._access
+
+    def is_object(self, generic_path):
+        """Determine if the generic path (with trailing '.') is an implemented object"""
+        return generic_path in self._objects
+
+    def is_table(self, generic_path):
+        """Determine if the generic path (with trailing '.') is an implemented multi-instance object"""
+        return generic_path in self._tables
+
+    def get_access(self, generic_path):
+        """Retrieve the access of the implemented parameter, or None"""
+        return self._access.get(generic_path)
+
+    def get_child_objects(self, generic_path):
+        """Retrieve the implemented objects directly below the generic object path"""
+        return list(self._child_objects.get(generic_path, ()))
+
+    def get_param_objects(self, generic_path):
+        """Retrieve the implemented objects, at or below the generic object path, that contain parameters"""
+        return list(self._param_objects.get(generic_path, ()))
+
+
+class SortedAccessMap(collections.abc.Mapping):
+    """The (generic parameter path -> access) of a sorted access map file, looked up in place
+
+    The file is mmap'd rather than read, and each lookup is a binary search over its lines
+    """
+    def __init__(self, filename):
+        """Initialize the SortedAccessMap from a file of tab-separated (path, access) lines sorted by path"""
+        self._filename = filename
+        self._len = None
+        with open(filename, "rb") as access_map_file:
+            if os.fstat(access_map_file.fileno()).st_size:
+                self._buf = mmap.mmap(access_map_file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._buf = b""
+
+    def _split_line(self, start):
+        """Retrieve the (path, access, end of line) of the line starting at start"""
+        end = self._buf.find(b"\n", start)
+        if end < 0:
+            end = len(self._buf)
+        tab = self._buf.find(b"\t", start, end)
+        if tab < 0:
+            raise ValueError("Missing access in [{}] at offset {}".format(self._filename, start))
+        return self._buf[start:tab], self._buf[tab + 1:end], end
+
+    def _find(self, path):
+        """Retrieve the access of the path as bytes, or None"""
+        target = path.encode()
+        lo, hi = 0, len(self._buf)
+
+        # Lines starting before lo have a lower path, lines starting at or after hi don't
+        while lo < hi:
+            mid = (lo + hi) // 2
+            newline = self._buf.rfind(b"\n", lo, mid)
+            start = lo if newline < 0 else newline + 1
+            line_path, _, end = self._split_line(start)
+            if line_path < target:
+                lo = end + 1
+            else:
+                hi = start
+
+        if lo >= len(self._buf):
+            return None
+
+        line_path, access, _ = self._split_line(lo)
+        return access if line_path == target else None
+
+    def __getitem__(self, path):
+        """Retrieve the access of the generic parameter path"""
+        access = self._find(path)
+        if access is None:
+            raise KeyError(path)
+        return access.decode()
+
+    def __contains__(self, path):
+        """Determine if the generic parameter path is in the access map"""
+        return isinstance(path, str) and self._find(path) is not None
+
+    def __iter__(self):
+        """Iterate over the generic parameter paths in sorted order"""
+        for path, _ in self.items():
+            yield path
+
+    def items(self):
+        """Iterate over the (generic parameter path, access) pairs in sorted order"""
+        start = 0
+        while start < len(self._buf):
+            path, access, end = self._split_line(start)
+            yield path.decode(), access.decode()
+            start = end + 1
+
+    def __len__(self):
+        """Return the number of parameters in the access map"""
+        if self._len is None:
+            self._len = sum(1 for _ in self.items())
+        return self._len
+
+
+def _compile_dm(dm_filename):
+    """Read and index the Implemented Data Model file (JSON or a sorted access map)"""
+    if dm_filename.endswith(SORTED_ACCESS_MAP_SUFFIX):
+        dm = dict(SortedAccessMap(dm_filename).items())
+    else:
+        with open(dm_filename, "r") as dm_in_json:
+            dm = json.load(dm_in_json)
+    return dm, SchemaIndex(dm)
+
+
+def load_dm(dm_filename):
+    """Retrieve the Implemented Data Model and its SchemaIndex, from the schema cache when the file hasn't changed
+
+    Raises ValueError if the file is not properly formatted JSON
+    """
+    return schema_cache.load(dm_filename, "schema_index", _compile_dm)
+
+
+def open_access_map(dm_filename):
+    """Retrieve the (generic parameter path -> access) of the Implemented Data Model file
+
+    A sorted access map is searched in place instead of being read, JSON is loaded through load_dm
+    """
+    if dm_filename.endswith(SORTED_ACCESS_MAP_SUFFIX):
+        return SortedAccessMap(dm_filename)
+    return load_dm(dm_filename)[0]
@@ -0,0 +1,123 @@
+"""
+# File Name: schema_cache.py
+#
+# Description: Compiled Schema Cache
+#
+# Functionality:
+#  - Keeps the compiled form of a schema file (the DataModel index, the SchemaIndex of an
+#    Implemented Data Model, ...) in a pickle next to it: <source>.<name>.cache
+#  - The cache is keyed by the SHA-256 of the source file's content; its size and mtime are
+#    recorded too, so that an unchanged file is recognized without hashing it again
+#  - A missing, stale or unreadable cache is recompiled and rewritten automatically
+#  - A cache that can't be written (e.g. read-only directory) only costs the recompilation
+#
+#   Function: load(source_filename, name, compile_func): compile_func(source_filename) -> value
+#   Function: get_cache_filename(source_filename, name)
+#
+"""
+
+import os
+import pickle
+import hashlib
+import logging
+import tempfile
+
+
+# Bump when the layout of a compiled value changes, so that existing caches are recompiled
+SCHEMA_CACHE_VERSION = 3
+SCHEMA_CACHE_HASH_CHUNK_SIZE = 1024 * 1024
+
+_log = logging.getLogger("SchemaCache")
+
+
+def get_cache_filename(source_filename, name):
+    """Retrieve the name of the cache file of the source file's compiled form"""
+    return "{}.{}.cache".format(source_filename, name)
+
+
+def _hash_file(filename):
+    """Retrieve the SHA-256 of the file's content"""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as source_file:
+        for chunk in iter(lambda: source_file.read(SCHEMA_CACHE_HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_cache(cache_filename, name):
+    """Retrieve (header, cache file) if the cache is for name, None if it's missing or unreadable"""
+    try:
+        cache_file = open(cache_filename, "rb")
+    except OSError:
+        return None
+
+    try:
+        header = pickle.load(cache_file)
+        if header.get("version") == SCHEMA_CACHE_VERSION and header.get("name") == name:
+            return header, cache_file
+    except Exception as load_err:
+        _log.warning("Ignoring the unreadable schema cache [%s]: %s", cache_filename, load_err)
+
+    cache_file.close()
+    return None
+
+
+def _write_cache(cache_filename, header, value):
+    """Write the cache file, replacing the previous one atomically
+
+    Each writer has its own temporary file, as several processes may compile the same schema at once
+    """
+    tmp_filename = None
+    try:
+        tmp_fd, tmp_filename = tempfile.mkstemp(prefix=os.path.basename(cache_filename) + ".",
+                                                suffix=".tmp", dir=os.path.dirname(cache_filename) or ".")
+        with os.fdopen(tmp_fd, "wb") as cache_file:
+            pickle.dump(header, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(value, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, cache_filename)
+    except OSError as write_err:
+        _log.warning("Unable to write the schema cache [%s]: %s", cache_filename, write_err)
+        if tmp_filename is not None and os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def load(source_filename, name, compile_func):
+    """Retrieve the compiled form of the source file, from its cache when the file hasn't changed
+
+    Exceptions raised by compile_func(source_filename) are passed on, and nothing is cached
+    """
+    cache_filename = get_cache_filename(source_filename, name)
+    source_stat = os.stat(source_filename)
+    digest = None
+
+    cached = _read_cache(cache_filename, name)
+    if cached is not None:
+        header, cache_file = cached
+        with cache_file:
+            unchanged = header["size"] == source_stat.st_size and header["mtime_ns"] == source_stat.st_mtime_ns
+            if not unchanged:
+                # Touched or copied, only a change of content makes the cache stale
+                digest = _hash_file(source_filename)
+                unchanged = header["digest"] == digest
+
+            if unchanged:
+                try:
+                    value = pickle.load(cache_file)
+                except Exception as load_err:
+                    _log.warning("Ignoring the unreadable schema cache [%s]: %s", cache_filename, load_err)
+                else:
+                    _log.debug("Loaded [%s] from its schema cache [%s]", source_filename, cache_filename)
+                    if digest is not None:
+                        _write_cache(cache_filename, dict(header, size=source_stat.st_size,
+                                                          mtime_ns=source_stat.st_mtime_ns), value)
+                    return value
+
+    _log.debug("Compiling [%s] into its schema cache [%s]", source_filename, cache_filename)
+    if digest is None:
+        digest = _hash_file(source_filename)
+    value = compile_func(source_filename)
+
+    header = {"version": SCHEMA_CACHE_VERSION, "name": name, "digest": digest,
+              "size": source_stat.st_size, "mtime_ns": source_stat.st_mtime_ns}
+    _write_cache(cache_filename, header, value)
+    return value
@@ -0,0 +1,216 @@
+"""
+# File Name: test_agent_db.py
+#
+# Description: Tests of the Agent Database change log and transactions on a temporary copy of test-db.json
+#
+# Usage: python -m unittest test_agent_db   (or: python -m pytest test_agent_db.py)
+#
+"""
+
+import os
+import json
+import errno
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import agent_db
+import change_log
+
+
+class ChangeLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.snapshot_filename = os.path.join(self.tmp_dir, "test-db.json")
+        shutil.copy("test-db.json", self.snapshot_filename)
+        self.log_filename = self.snapshot_filename + ".log"
+        self.change_log = change_log.ChangeLog(self.snapshot_filename)
+
+    def tearDown(self):
+        self.change_log.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def reload(self):
+        """Retrieve the persisted database as a new ChangeLog sees it"""
+        reloaded = change_log.ChangeLog(self.snapshot_filename)
+        return reloaded.load()
+
+    def read_log(self):
+        with open(self.log_filename, "r") as log_file:
+            return log_file.read()
+
+    def test_load_replays_the_log_on_the_snapshot(self):
+        self.change_log.record_set("Device.Test2.Param", "changed")
+        self.change_log.record_delete("Device.DeviceInfo.FriendlyName")
+        self.change_log.commit()
+
+        data = self.reload()
+
+        self.assertEqual(data["Device.Test2.Param"], "changed")
+        self.assertNotIn("Device.DeviceInfo.FriendlyName", data)
+        self.assertEqual(data["Device.DeviceInfo.Manufacturer"], "ARRIS")
+
+    def test_torn_record_is_truncated(self):
+        self.change_log.record_set("Device.Test2.Param", "first")
+        self.change_log.commit()
+        with open(self.log_filename, "a") as log_file:
+            log_file.write('["set", "Device.Test2.Param", "to')
+
+        self.assertEqual(self.change_log.load()["Device.Test2.Param"], "first")
+        self.change_log.record_set("Device.Test2.Param", "second")
+        self.change_log.commit()
+
+        self.assertEqual(self.read_log().splitlines(),
+                         ['["set", "Device.Test2.Param", "first"]', '["set", "Device.Test2.Param", "second"]'])
+        self.assertEqual(self.reload()["Device.Test2.Param"], "second")
+
+    def test_compact_folds_the_log_into_the_snapshot(self):
+        self.change_log.record_set("Device.Test2.Param", "compacted")
+        self.change_log.commit()
+
+        self.change_log.compact()
+
+        self.assertFalse(os.path.exists(self.log_filename))
+        with open(self.snapshot_filename, "r") as snapshot_file:
+            self.assertEqual(json.load(snapshot_file)["Device.Test2.Param"], "compacted")
+        self.assertEqual(self.reload()["Device.Test2.Param"], "compacted")
+
+    def test_rollback_to_savepoint(self):
+        self.change_log.record_set("Device.Test2.Param", "kept")
+        savepoint = self.change_log.savepoint()
+        self.change_log.record_set("Device.DeviceInfo.FriendlyName", "dropped")
+
+        self.assertTrue(self.change_log.rollback_to(savepoint))
+        self.change_log.commit()
+        self.assertFalse(self.change_log.rollback_to(savepoint))
+
+        data = self.reload()
+        self.assertEqual(data["Device.Test2.Param"], "kept")
+        self.assertEqual(data["Device.DeviceInfo.FriendlyName"], "dummy")
+
+    def test_failed_commit_leaves_nothing_in_the_log(self):
+        self.change_log.record_set("Device.Test2.Param", "first")
+        self.change_log.commit()
+        log_size = os.path.getsize(self.log_filename)
+        self.change_log.record_set("Device.Test2.Param", "second")
+
+        # The records are written but the fsync fails, as it would on a full disk
+        with mock.patch("change_log.os.fsync", side_effect=OSError(errno.ENOSPC, "No space left on device")):
+            with self.assertRaises(OSError):
+                self.change_log.commit()
+
+        self.assertEqual(os.path.getsize(self.log_filename), log_size)
+        self.change_log.commit()
+        self.assertEqual(self.read_log().splitlines(),
+                         ['["set", "Device.Test2.Param", "first"]', '["set", "Device.Test2.Param", "second"]'])
+
+    def test_unserializable_change_stays_pending(self):
+        self.change_log.record_set("Device.Test2.Param", "valid")
+        savepoint = self.change_log.savepoint()
+        self.change_log.record_set("Device.DeviceInfo.FriendlyName", object())
+
+        with self.assertRaises(TypeError):
+            self.change_log.commit()
+
+        self.assertTrue(self.change_log.rollback_to(savepoint))
+        self.change_log.commit()
+        self.assertEqual(self.reload()["Device.Test2.Param"], "valid")
+
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        # Agent opens test-dm.json and test-db.json in the current directory
+        self.saved_cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        for filename in ("test-dm.json", "test-db.json"):
+            shutil.copy(filename, self.tmp_dir)
+        os.chdir(self.tmp_dir)
+
+        self.agent = agent_db.Agent("test")
+        self.db = self.agent.db
+        self.agent.Set([{"path": "Device.Test2.", "param_settings": [{"param": "Param", "value": "original"}]}])
+
+    def tearDown(self):
+        self.db._change_log.close()
+        os.chdir(self.saved_cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def reload(self):
+        """Retrieve the persisted value of Device.Test2.Param as a new Database sees it"""
+        db = agent_db.Database("test-dm.json", "test-db.json", None)
+        db._change_log.close()
+        return db.get("Device.Test2.Param")
+
+    def run_thread(self, target, *args):
+        """Run target in a thread, returning the thread once it has ended (or 5 seconds have passed)"""
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        thread.join(5.0)
+        return thread
+
+    def test_commit_saves_the_changes(self):
+        self.db.begin()
+        self.db.update("Device.Test2.Param", "committed")
+        self.db.commit()
+
+        self.assertEqual(self.reload(), "committed")
+
+    def test_rollback_undoes_the_changes(self):
+        self.db.begin()
+        self.db.update("Device.Test2.Param", "rolled back")
+        instance_num = self.db.insert("Device.Test.")
+        self.db.update("Device.Test.{}.Russell".format(instance_num), "rolled back")
+        self.db.rollback()
+
+        self.assertEqual(self.db.get("Device.Test2.Param"), "original")
+        self.assertEqual(self.db.find_instances("Device.Test."), [])
+        self.assertEqual(self.reload(), "original")
+
+    def test_transactions_are_not_nested(self):
+        self.db.begin()
+        with self.assertRaises(RuntimeError):
+            self.db.begin()
+        self.db.rollback()
+
+    def test_failed_commit_is_rolled_back(self):
+        self.db._change_log._log_filename = os.path.join(self.tmp_dir, "missing", "test-db.json.log")
+
+        self.agent.Set([{"path": "Device.Test2.", "param_settings": [{"param": "Param", "value": "lost"}]}])
+
+        self.assertEqual(self.db.get("Device.Test2.Param"), "original")
+        # The transaction has ended, on this thread and the others
+        self.db.begin()
+        self.db.rollback()
+        self.assertFalse(self.run_thread(self.agent.Set, []).is_alive())
+
+    def test_insert_within_a_transaction_does_not_deadlock(self):
+        instance_nums = []
+        in_transaction = threading.Event()
+        inserting = threading.Event()
+
+        def owner():
+            self.db.begin()
+            instance_nums.append(self.db.insert("Device.Test."))
+            in_transaction.set()
+            inserting.wait(5.0)
+            instance_nums.append(self.db.insert("Device.Test."))
+            self.db.commit()
+
+        def other():
+            in_transaction.wait(5.0)
+            inserting.set()
+            instance_nums.append(self.db.insert("Device.Test."))
+
+        other_thread = threading.Thread(target=other, daemon=True)
+        other_thread.start()
+        self.assertFalse(self.run_thread(owner).is_alive())
+        other_thread.join(5.0)
+
+        self.assertFalse(other_thread.is_alive())
+        self.assertEqual(sorted(instance_nums), [1, 2, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()
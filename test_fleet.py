@@ -0,0 +1,57 @@
+"""
+# File Name: test_fleet.py
+#
+# Description: Tests of the fleet-wide Device Twin collection against a local stub WebPA server
+#
+# Usage: python -m unittest test_fleet   (or: python -m pytest test_fleet.py)
+#
+"""
+
+import io
+import json
+import threading
+import unittest
+
+import fleet
+import nucleus
+from test_webpa import StubWebPAServer
+
+
+class CollectTwinsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubWebPAServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        nucleus.device_subtree_cache.clear()
+
+    def tearDown(self):
+        nucleus.device_subtree_cache.clear()
+        self.server.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_requests_in_flight_are_limited(self):
+        self.server.script = [(200, 0.02)] * (3 * len(nucleus.DEVICE_TWIN_PATHS))
+        out_file = io.StringIO()
+
+        stats = fleet.collect_twins(self.server.base_url, "c2VjcmV0", ["112233445566", "112233445567", "112233445568"],
+                                    out_file, max_in_flight=3, max_requests=2)
+
+        self.assertEqual(stats.succeeded, 3)
+        self.assertEqual(len(self.server.requests), 3 * len(nucleus.DEVICE_TWIN_PATHS))
+        self.assertLessEqual(self.server.max_active, 2)
+        # A fleet run doesn't fill the shared subtree cache
+        self.assertEqual(len(nucleus.device_subtree_cache), 0)
+
+    def test_partial_twin_is_not_a_success(self):
+        self.server.script = [(404, 0)]
+        out_file = io.StringIO()
+
+        stats = fleet.collect_twins(self.server.base_url, "c2VjcmV0", ["112233445566"], out_file, max_requests=1)
+
+        self.assertEqual((stats.succeeded, stats.partial, stats.failed), (0, 1, 0))
+        self.assertEqual(stats.summary()["failed_paths"], {"no such path": 1})
+        self.assertEqual(json.loads(out_file.getvalue())["mac"], "112233445566")
+
+
+if __name__ == "__main__":
+    unittest.main()
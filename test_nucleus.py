@@ -0,0 +1,156 @@
+"""
+# File Name: test_nucleus.py
+#
+# Description: Tests of the concurrent Device Twin retrieval against a local stub WebPA server
+#
+# Usage: python -m unittest test_nucleus   (or: python -m pytest test_nucleus.py)
+#
+"""
+
+import json
+import threading
+import unittest
+import concurrent.futures
+from unittest import mock
+
+import webpa
+import nucleus
+import twin_cache
+from test_webpa import StubWebPAServer
+
+
+class GetConcurrentTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubWebPAServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = webpa.WebPAClient(self.server.base_url, "c2VjcmV0", backoff_factor=0)
+        self.db = nucleus.Database("erdk-dm.json", self.server.base_url, "c2VjcmV0", client=self.client)
+
+        # A single worker, so that the queries wait on each other
+        self.saved_executor = webpa._executor
+        webpa._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def tearDown(self):
+        webpa._executor.shutdown(wait=False, cancel_futures=True)
+        webpa._executor = self.saved_executor
+        self.client.close()
+        self.server.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_time_queued_is_not_a_timeout(self):
+        self.server.script = [(200, 0.4)] * 3
+        paths = ["Device.WiFi.", "Device.Ethernet.", "Device.Hosts."]
+
+        results, failed = self.db.get_concurrent("112233445566", paths, timeout=1.0)
+
+        self.assertEqual(failed, {})
+        self.assertEqual(list(results), paths)
+
+    def test_timed_out_query_is_not_retried(self):
+        self.server.script = [(200, 5.0)]
+
+        results, failed = self.db.get_concurrent("112233445566", ["Device.WiFi."], timeout=0.3)
+
+        self.assertEqual(results, {})
+        self.assertEqual(failed, {"Device.WiFi.": "timeout"})
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_queries_queued_past_the_deadline_are_not_sent(self):
+        self.server.script = [(200, 0.5)] * 3
+        paths = ["Device.WiFi.", "Device.Ethernet.", "Device.Hosts."]
+
+        results, failed = self.db.get_concurrent("112233445566", paths, timeout=1.0, deadline=0.2)
+
+        self.assertEqual(results, {})
+        self.assertEqual(failed, {path: "deadline exceeded" for path in paths})
+        webpa._executor.shutdown(wait=True)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_queries_completed_after_the_deadline_are_kept(self):
+        paths = ["Device.WiFi.", "Device.Ethernet."]
+
+        def as_completed(futures, timeout):
+            # The deadline passes while the last queries complete
+            concurrent.futures.wait(futures)
+            raise concurrent.futures.TimeoutError()
+
+        with mock.patch("concurrent.futures.as_completed", as_completed):
+            results, failed = self.db.get_concurrent("112233445566", paths, timeout=1.0)
+
+        self.assertEqual(failed, {})
+        self.assertEqual(list(results), paths)
+
+
+class NucleusDeviceTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubWebPAServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.samples = twin_cache.SubtreeCache()
+        self.device = nucleus.NucleusDevice(self.server.base_url, "c2VjcmV0", "112233445566", samples=self.samples)
+
+    def tearDown(self):
+        self.server.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def age_samples(self, seconds, paths=None):
+        """Make the samples of the paths (default: all of them) older by seconds"""
+        samples = self.samples._samples["112233445566"]
+        for path in paths or list(samples):
+            sample_time, values = samples[path]
+            samples[path] = (sample_time - seconds, values)
+
+    def test_device_info_is_retrieved_with_one_query(self):
+        self.device.get()
+
+        device_info_queries = [path for path, _ in self.server.requests if "Device.DeviceInfo." in path]
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(device_info_queries,
+                         ["/api/v2/device/mac:112233445566/config?names=" + ",".join(nucleus.DEVICE_INFO_PARAMS)])
+
+    def test_fresh_samples_are_served(self):
+        self.device.get()
+        self.device.get()
+
+        self.assertEqual(len(self.server.requests), len(nucleus.DEVICE_TWIN_PATHS))
+
+    def test_uptime_is_derived_from_its_sample(self):
+        self.device.get()
+        self.age_samples(100, [nucleus.DEVICE_TWIN_PATHS[0]])
+
+        device_info = json.loads(self.device.get())["Device"]["DeviceInfo"]
+
+        self.assertEqual(device_info["UpTime"], 101)
+        self.assertEqual(device_info["Manufacturer"], 1)
+
+    def test_stale_subtree_that_fails_is_not_served(self):
+        self.device.get()
+        self.age_samples(3599, ["Device.WiFi.", "Device.Hosts."])
+        self.server.statuses = {"Device.WiFi.": 404}
+
+        twin = json.loads(self.device.get())
+
+        self.assertEqual(self.device.failed_paths, {"Device.WiFi.": "no such path"})
+        self.assertNotIn("WiFi", twin["Device"])
+        self.assertIn("Hosts", twin["Device"])
+
+    def test_unreachable_device_is_not_served_from_samples(self):
+        self.device.get()
+        self.age_samples(3599)
+        self.server.statuses = {path: 520 for path in nucleus.DEVICE_TWIN_PATHS}
+
+        with self.assertRaises(nucleus.NoSuchPathError):
+            self.device.get()
+
+    def test_samples_are_not_used_past_the_hard_max_age(self):
+        self.device.get()
+        self.age_samples(twin_cache.SUBTREE_CACHE_HARD_MAX_AGE)
+
+        self.assertIsNone(self.samples.get_sample("112233445566", nucleus.DEVICE_TWIN_PATHS[0]))
+        self.assertEqual(self.samples.get_stale_paths("112233445566", nucleus.DEVICE_TWIN_PATHS,
+                                                      lambda path: 86400), nucleus.DEVICE_TWIN_PATHS)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,191 @@
+"""
+# File Name: test_webpa.py
+#
+# Description: Tests of the Connection-Pooled WebPA Client against a local stub WebPA server
+#
+# Usage: python -m unittest test_webpa   (or: python -m pytest test_webpa.py)
+#
+"""
+
+import json
+import socket
+import threading
+import unittest
+import http.server
+
+import requests
+
+import webpa
+
+
+class StubWebPAHandler(http.server.BaseHTTPRequestHandler):
+    """Answers /config requests with the next scripted (status, delay) of the server, or the status of the names
+
+    Each of the comma-separated names is returned as a parameter with the value "1"
+    """
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        """Count the connections made to the server"""
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        """Keep the test output quiet"""
+
+    def do_GET(self):
+        """Reply with the next scripted response, a 200 with the requested names once the script is done"""
+        with self.server.lock:
+            self.server.requests.append((self.path, self.headers.get("Authorization")))
+            status, delay = self.server.script.pop(0) if self.server.script else (200, 0)
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+
+        if delay:
+            self.server.release.wait(delay)
+        with self.server.lock:
+            self.server.active -= 1
+
+        names = self.path.split("names=", 1)[-1]
+        status = self.server.statuses.get(names, status)
+        body = json.dumps({"parameters": [{"name": name, "value": "1", "dataType": 2, "parameterCount": 1}
+                                          for name in names.split(",")],
+                           "statusCode": status}).encode()
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            # The client gave up on the request
+            pass
+
+
+class StubWebPAServer(http.server.ThreadingHTTPServer):
+    """A local WebPA server whose responses are scripted by the tests"""
+    daemon_threads = True
+
+    def __init__(self):
+        """Initialize the StubWebPAServer on a free local port"""
+        super().__init__(("127.0.0.1", 0), StubWebPAHandler)
+        self.lock = threading.Lock()
+        self.release = threading.Event()
+        self.script = []
+        self.statuses = {}
+        self.requests = []
+        self.connections = 0
+        self.active = 0
+        self.max_active = 0
+
+    @property
+    def base_url(self):
+        """Retrieve the WebPA base URL of the server"""
+        return "http://127.0.0.1:{}/api/v2/device/".format(self.server_address[1])
+
+
+class WebPAClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubWebPAServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = webpa.WebPAClient(self.server.base_url, "c2VjcmV0", backoff_factor=0, timeout=(1.0, 1.0))
+
+    def tearDown(self):
+        self.client.close()
+        self.server.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_config(self):
+        response = self.client.get_config("112233445566", "Device.DeviceInfo.UpTime")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["parameters"][0]["name"], "Device.DeviceInfo.UpTime")
+        self.assertEqual(self.server.requests,
+                         [("/api/v2/device/mac:112233445566/config?names=Device.DeviceInfo.UpTime", "Basic c2VjcmV0")])
+
+    def test_connection_is_reused(self):
+        for _ in range(5):
+            self.assertEqual(self.client.get_config("112233445566", "Device.WiFi.").status_code, 200)
+
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_concurrent_requests_are_pooled(self):
+        threads = [threading.Thread(target=self.client.get_config, args=("112233445566", "Device.WiFi."))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for _ in range(8):
+            self.client.get_config("112233445566", "Device.WiFi.")
+
+        self.assertEqual(len(self.server.requests), 12)
+        self.assertLessEqual(self.server.connections, 4)
+
+    def test_retries_server_errors(self):
+        self.server.script = [(503, 0), (520, 0)]
+
+        response = self.client.get_config("112233445566", "Device.WiFi.")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_returns_last_response_once_retries_are_used_up(self):
+        self.server.script = [(520, 0)] * (webpa.WEBPA_RETRIES + 1)
+
+        response = self.client.get_config("112233445566", "Device.WiFi.")
+
+        # The caller can still tell a 520 (device not reachable) from other errors
+        self.assertEqual(response.status_code, 520)
+        self.assertEqual(len(self.server.requests), webpa.WEBPA_RETRIES + 1)
+
+    def test_client_errors_are_not_retried(self):
+        self.server.script = [(404, 0)]
+
+        self.assertEqual(self.client.get_config("112233445566", "Device.Nope.").status_code, 404)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_connection_error(self):
+        with socket.socket() as unused_sock:
+            unused_sock.bind(("127.0.0.1", 0))
+            port = unused_sock.getsockname()[1]
+
+        client = webpa.WebPAClient("http://127.0.0.1:{}/api/v2/device/".format(port), "c2VjcmV0",
+                                   retries=1, backoff_factor=0)
+        with self.assertRaises(requests.ConnectionError):
+            client.get_config("112233445566", "Device.WiFi.")
+        client.close()
+
+    def test_read_timeout(self):
+        self.server.script = [(200, 5.0)] * (webpa.WEBPA_RETRIES + 1)
+
+        with self.assertRaises(requests.RequestException):
+            self.client.get_config("112233445566", "Device.WiFi.", timeout=(1.0, 0.2))
+
+    def test_fan_out_reads_are_not_retried(self):
+        self.server.script = [(200, 5.0)] * (webpa.WEBPA_RETRIES + 1)
+
+        with self.assertRaises(requests.ReadTimeout):
+            self.client.get_config("112233445566", "Device.WiFi.", timeout=(1.0, 0.2), retry_reads=False)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_fan_out_retry_budget(self):
+        self.server.script = [(503, 0)] * (webpa.WEBPA_RETRIES + 1)
+
+        response = self.client.get_config("112233445566", "Device.WiFi.", retry_reads=False)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(self.server.requests), webpa.WEBPA_FAN_OUT_RETRIES + 1)
+
+    def test_get_client_is_shared(self):
+        client = webpa.get_client(self.server.base_url, "c2VjcmV0")
+
+        self.assertIs(webpa.get_client(self.server.base_url, "c2VjcmV0"), client)
+        self.assertIsNot(webpa.get_client(self.server.base_url, "b3RoZXI="), client)
+
+
+if __name__ == "__main__":
+    unittest.main()
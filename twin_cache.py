@@ -0,0 +1,249 @@
+"""
+# File Name: twin_cache.py
+#
+# Description: In-Process Device Twin Cache
+#
+# Functionality:
+#  - In-memory cache of Device Twins keyed by MAC
+#  - Each entry is fresh for ttl seconds after it was retrieved
+#  - Stale-while-revalidate: until hard_ttl, an expired entry is still returned immediately
+#    while a background worker retrieves a new value
+#  - Bounded size, the least recently used entry is evicted when full
+#  - Single-flight: concurrent misses for the same MAC share one upstream retrieval
+#  - The last sample of each Device Twin subtree, so that only the stale subtrees are re-retrieved,
+#    no sample is used once it is older than hard_max_age
+#  - Hit/stale/miss/coalesced counts are exported through metrics.count_cache_request
+#
+#   Class: TwinCache(object)
+#    - __init__(name, ttl, max_size, hard_ttl)
+#    - get(key, loader)
+#    - invalidate(key)
+#    - clear()
+#   Class: SubtreeCache(object)
+#    - __init__(max_size, hard_max_age)
+#    - get_stale_paths(mac, paths, max_age_func)
+#    - update(mac, results)
+#    - get_sample(mac, path)
+#    - invalidate(mac)
+#    - clear()
+#
+"""
+
+import time
+import logging
+import threading
+import concurrent.futures
+from collections import OrderedDict
+
+import metrics
+
+
+TWIN_CACHE_TTL = 10.0
+TWIN_CACHE_MAX_SIZE = 10000
+TWIN_CACHE_HARD_TTL = 60.0
+TWIN_CACHE_REVALIDATE_WORKERS = 4
+SUBTREE_CACHE_MAX_SIZE = 10000
+SUBTREE_CACHE_HARD_MAX_AGE = 3600.0
+
+
+class _Flight:
+    """A retrieval in progress that other callers can wait on"""
+    __slots__ = ("done", "value", "error", "invalidated")
+
+    def __init__(self):
+        """Initialize the _Flight"""
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.invalidated = False
+
+
+class TwinCache:
+    """A TTL + LRU cache that coalesces concurrent retrievals of the same key"""
+    def __init__(self, name="device_twin", ttl=TWIN_CACHE_TTL, max_size=TWIN_CACHE_MAX_SIZE, hard_ttl=None):
+        """Initialize the TwinCache
+
+        ttl is the soft TTL, hard_ttl (if longer than ttl) enables stale-while-revalidate
+        """
+        self._name = name
+        self._ttl = ttl
+        self._hard_ttl = max(ttl, hard_ttl) if hard_ttl is not None else ttl
+        self._max_size = max_size
+
+        # key -> (fresh until, usable until, value), least recently used first
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._revalidate_executor = None
+
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    def __len__(self):
+        """Return the number of cached entries"""
+        return len(self._entries)
+
+    def get(self, key, loader):
+        """Retrieve the cached value of the key, calling loader() to retrieve it when missing or expired
+
+        An exception raised by loader() is passed on to every caller waiting on it, and nothing is cached
+        """
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                if entry[0] > now:
+                    metrics.count_cache_request(self._name, "hit")
+                    return entry[2]
+
+                # Stale but still usable: serve it and retrieve a new value in the background
+                metrics.count_cache_request(self._name, "stale")
+                if key not in self._in_flight:
+                    flight = _Flight()
+                    self._in_flight[key] = flight
+                    self._get_revalidate_executor().submit(self._revalidate, key, flight, loader)
+                return entry[2]
+
+            flight = self._in_flight.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = _Flight()
+                self._in_flight[key] = flight
+
+        if not is_leader:
+            metrics.count_cache_request(self._name, "coalesced")
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        metrics.count_cache_request(self._name, "miss")
+        self._load(key, flight, loader)
+        return flight.value
+
+    def invalidate(self, key):
+        """Drop the cached value of the key, return True if there was one
+
+        A retrieval of the key that is already in progress won't be cached
+        """
+        with self._lock:
+            flight = self._in_flight.get(key)
+            if flight is not None:
+                flight.invalidated = True
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        """Drop every cached value"""
+        with self._lock:
+            for flight in self._in_flight.values():
+                flight.invalidated = True
+            self._entries.clear()
+
+    def _load(self, key, flight, loader):
+        """Retrieve the value of the key for everyone waiting on the flight, and cache it"""
+        try:
+            flight.value = loader()
+        except Exception as err:
+            flight.error = err
+            raise
+        else:
+            self._store(key, flight)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            flight.done.set()
+
+    def _revalidate(self, key, flight, loader):
+        """Retrieve a new value for a stale key in the background, keeping the stale one on failure"""
+        try:
+            self._load(key, flight, loader)
+        except Exception as err:
+            self._log.warning("Unable to revalidate [%s] in the %s cache: %s", key, self._name, err)
+
+    def _get_revalidate_executor(self):
+        """Retrieve the background workers that revalidate stale entries (called with the lock held)"""
+        if self._revalidate_executor is None:
+            self._revalidate_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=TWIN_CACHE_REVALIDATE_WORKERS, thread_name_prefix="TwinCacheRevalidate")
+
+        return self._revalidate_executor
+
+    def _store(self, key, flight):
+        """Cache the retrieved value of the key, evicting the least recently used entries beyond max_size"""
+        with self._lock:
+            if flight.invalidated:
+                return
+
+            now = time.monotonic()
+            self._entries[key] = (now + self._ttl, now + self._hard_ttl, flight.value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self._max_size:
+                evicted_key, _ = self._entries.popitem(last=False)
+                self._log.debug("Evicted [%s] from the %s cache", evicted_key, self._name)
+
+
+class SubtreeCache:
+    """The last sample (time, values) of each Device Twin subtree, per MAC, LRU bounded by MAC"""
+    def __init__(self, max_size=SUBTREE_CACHE_MAX_SIZE, hard_max_age=SUBTREE_CACHE_HARD_MAX_AGE):
+        """Initialize the SubtreeCache, a max_size of 0 keeps no samples
+
+        hard_max_age caps the age of the samples used, whatever max_age_func allows
+        """
+        self._max_size = max_size
+        self._hard_max_age = hard_max_age
+
+        # mac -> {subtree path -> (sample time, values)}, least recently used first
+        self._samples = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Return the number of MACs with samples"""
+        return len(self._samples)
+
+    def get_stale_paths(self, mac, paths, max_age_func):
+        """Retrieve the paths whose last sample is missing or older than max_age_func(path) (or hard_max_age) seconds"""
+        now = time.monotonic()
+        with self._lock:
+            samples = self._samples.get(mac, {})
+            if samples:
+                self._samples.move_to_end(mac)
+
+            return [path for path in paths
+                    if path not in samples or now - samples[path][0] >= min(max_age_func(path), self._hard_max_age)]
+
+    def update(self, mac, results):
+        """Record a new sample of each subtree in results (subtree path -> values)"""
+        now = time.monotonic()
+        with self._lock:
+            samples = self._samples.setdefault(mac, {})
+            self._samples.move_to_end(mac)
+            for path, values in results.items():
+                samples[path] = (now, values)
+
+            while len(self._samples) > self._max_size:
+                self._samples.popitem(last=False)
+
+    def get_sample(self, mac, path):
+        """Retrieve the (age in seconds, values) of the last sample of the subtree, None if missing or too old"""
+        with self._lock:
+            sample = self._samples.get(mac, {}).get(path)
+
+        if sample is None:
+            return None
+
+        sample_age = time.monotonic() - sample[0]
+        if sample_age >= self._hard_max_age:
+            return None
+
+        return sample_age, sample[1]
+
+    def invalidate(self, mac):
+        """Drop every sample of the MAC, return True if there were any"""
+        with self._lock:
+            return self._samples.pop(mac, None) is not None
+
+    def clear(self):
+        """Drop every sample"""
+        with self._lock:
+            self._samples.clear()
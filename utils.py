@@ -27,16 +27,57 @@ SOFTWARE.
 #   Class: ConfigMgr(object)
 #    - __init__(config_file_name, default_config_value_map)
 #    - get_cfg_item(config_key_name)
+#   Class: PathHelper(object)
+#    - static: build_path_from_parts(path_parts, partial_path_part_len)
+#    - static: generic_dm_path(path)
+#    - static: dm_regex(path, partial_path)
+#    - static: db_regex(path, partial_path)
+#   Class: TypedValueEncoder(json.JSONEncoder): datetime and bytes values
+#   Class: TreeHelper(object)
+#    - static: build_tree(flat_values): nested dicts from a (full parameter path -> value) map
+#    - static: iter_json(flat_values) / dump_json(flat_values, out_file) / to_json(flat_values):
+#      nested JSON streamed directly from the sorted flat map
 #   Class: IPAddr(object)
-#    - static: get_ip_addr(interface=None)
+#    - static: get_ip_addr(interface=None): cached for IP_ADDR_CACHE_TTL seconds
 #
 """
 
+import re
 import json
+import time
+import base64
+import socket
+import struct
 import random
 import datetime
+import platform
+import functools
+import threading
 import subprocess
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# The underlying OS doesn't change while we are running, so only check it once
+IS_DARWIN = platform.system() == "Darwin"
+
+# Number of seconds to keep serving a retrieved IP Address before looking it up again
+IP_ADDR_CACHE_TTL = 30.0
+
+# ioctl request to retrieve the IPv4 Address of an interface
+SIOCGIFADDR = 0xc0206921 if IS_DARWIN else 0x8915
+
+
+# Maximum number of generic paths and compiled path patterns to keep around
+PATH_PATTERN_CACHE_SIZE = 1024
+
+INST_NUM_REGEX = re.compile(r'\.[0-9]+\.')
+WILDCARD_REGEX = re.compile(r'\.\*\.')
+DOT_REGEX = re.compile(r'\.')
+
 
 class ConfigMgr:
     """A generic Configuration Manager"""
@@ -116,31 +157,194 @@ class PathHelper:
 
         return built_path
 
+    @staticmethod
+    @functools.lru_cache(maxsize=PATH_PATTERN_CACHE_SIZE)
+    def generic_dm_path(path):
+        """Turn a DM Path into a Generic one by replacing instance numbers and wildcards"""
+        generic_path = INST_NUM_REGEX.sub(r'.{i}.', path)  # Instance Number Addressing
+        generic_path = WILDCARD_REGEX.sub(r'.{i}.', generic_path)  # Wild-card Searching
+
+        return generic_path
+
+    @staticmethod
+    @functools.lru_cache(maxsize=PATH_PATTERN_CACHE_SIZE)
+    def dm_regex(path, partial_path):
+        """Compile a regex for determining whether or not a path is in the DM"""
+        dm_regex_str = "^" + PathHelper.generic_dm_path(path)  # Starts with
+        dm_regex_str = DOT_REGEX.sub(r'\.', dm_regex_str)  # Replace '.' with explicit '.' search
+
+        if partial_path:
+            dm_regex_str = dm_regex_str + ".*"
+
+        return re.compile(dm_regex_str)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=PATH_PATTERN_CACHE_SIZE)
+    def db_regex(path, partial_path):
+        """Compile a regex for determining whether or not a path is in the DB"""
+        db_regex_str = "^" + path
+        # Assuming that the internal storage is instance number based
+        db_regex_str = WILDCARD_REGEX.sub(r'.[0-9]+.', db_regex_str)
+        db_regex_str = DOT_REGEX.sub(r'\.', db_regex_str)
+
+        if partial_path:
+            db_regex_str = db_regex_str + ".*"
+
+        return re.compile(db_regex_str)
+
+
+
+class TypedValueEncoder(json.JSONEncoder):
+    """A JSON Encoder for the typed values decoded from WebPA (dateTime and base64 parameters)"""
+    def default(self, o):
+        """Encode datetimes as ISO 8601 (UTC with a "Z" suffix, as WebPA sends them) and bytes as base64"""
+        if isinstance(o, datetime.datetime):
+            if o.utcoffset() == datetime.timedelta(0):
+                return o.replace(tzinfo=None).isoformat() + "Z"
+            return o.isoformat()
+        if isinstance(o, bytes):
+            return base64.b64encode(o).decode("ascii")
+        return json.JSONEncoder.default(self, o)
+
+
+
+class TreeHelper:
+    """Turns flat (full parameter path -> value) maps into nested objects"""
+    @staticmethod
+    def build_tree(flat_values):
+        """Build nested dicts from the flat map in a single pass, keeping the order of the flat map"""
+        tree = {}
+
+        for path, value in flat_values.items():
+            parts = path.split(".")
+            node = tree
+            for part in parts[:-1]:
+                child = node.get(part)
+                if child is None and part not in node:
+                    child = {}
+                    node[part] = child
+                elif not isinstance(child, dict):
+                    raise TypeError("[{}] is both a parameter and an object".format(path))
+                node = child
+
+            if isinstance(node.get(parts[-1]), dict):
+                raise TypeError("[{}] is both a parameter and an object".format(path))
+            node[parts[-1]] = value
+
+        return tree
+
+    @staticmethod
+    def iter_json(flat_values):
+        """Yield the nested JSON encoding of the flat map, in sorted path order, without building the tree
+
+        Sorting the paths keeps every object's parameters and sub-objects together, so each object
+        is opened and closed exactly once
+        """
+        encode_str = json.encoder.encode_basestring_ascii
+        encode = TypedValueEncoder().encode
+        open_parts = []
+        need_comma = False
+
+        yield "{"
+        for path in sorted(flat_values):
+            parts = path.split(".")
+            obj_parts = parts[:-1]
+
+            # Close the objects that this path is not within
+            common_len = 0
+            for open_part, obj_part in zip(open_parts, obj_parts):
+                if open_part != obj_part:
+                    break
+                common_len += 1
+
+            chunk = "}" * (len(open_parts) - common_len)
+            if chunk:
+                need_comma = True
+            del open_parts[common_len:]
+
+            # Open the objects that this path is within
+            for obj_part in obj_parts[common_len:]:
+                open_parts.append(obj_part)
+                if ".".join(open_parts) in flat_values:
+                    raise TypeError("[{}] is both a parameter and an object".format(path))
+                chunk += (", " if need_comma else "") + encode_str(obj_part) + ": {"
+                need_comma = False
+
+            value = flat_values[path]
+            yield (chunk + (", " if need_comma else "") + encode_str(parts[-1]) + ": " +
+                   (encode_str(value) if value.__class__ is str else encode(value)))
+            need_comma = True
+
+        yield "}" * (len(open_parts) + 1)
+
+    @staticmethod
+    def dump_json(flat_values, out_file):
+        """Write the nested JSON encoding of the flat map to the file"""
+        for chunk in TreeHelper.iter_json(flat_values):
+            out_file.write(chunk)
+
+    @staticmethod
+    def to_json(flat_values):
+        """Retrieve the nested JSON encoding of the flat map as a string"""
+        return "".join(TreeHelper.iter_json(flat_values))
+
 
 
 class IPAddr:
     """IP Address Retrieval Tool"""
+    _cache = {}
+    _cache_lock = threading.Lock()
+
     @staticmethod
     def get_ip_addr(intf=None):
-        """Retrieve the IP Address after determining the underlying OS"""
-        arg = "uname -a"
-        proc = subprocess.Popen(arg, shell=True, stdout=subprocess.PIPE)
-        data = proc.communicate()
-        uname_out = data[0].decode("utf-8")
+        """Retrieve the IP Address, looking it up again once the cached one is IP_ADDR_CACHE_TTL seconds old"""
+        if intf is None:
+            intf = "en0" if IS_DARWIN else "eth0"
 
-        if uname_out.startswith("Darwin"):
-            if intf is None:
-                ip_addr = IPAddr._get_mac_ip_address()
-            else:
-                ip_addr = IPAddr._get_mac_ip_address(intf)
+        with IPAddr._cache_lock:
+            cached = IPAddr._cache.get(intf)
+            now = time.monotonic()
+
+            if cached is None or cached[0] <= now:
+                ip_addr = IPAddr._lookup_ip_addr(intf)
+                cached = (now + IP_ADDR_CACHE_TTL, ip_addr)
+                IPAddr._cache[intf] = cached
+
+        return cached[1]
+
+    @staticmethod
+    def clear_cache():
+        """Forget the cached IP Addresses"""
+        with IPAddr._cache_lock:
+            IPAddr._cache.clear()
+
+    @staticmethod
+    def _lookup_ip_addr(intf):
+        """Retrieve the IP Address of the interface from the kernel, or from the OS commands without fcntl"""
+        if fcntl is not None:
+            ip_addr = IPAddr._get_ioctl_ip_address(intf)
+        elif IS_DARWIN:
+            ip_addr = IPAddr._get_mac_ip_address(intf)
         else:
-            if intf is None:
-                ip_addr = IPAddr._get_rpi_ip_address()
-            else:
-                ip_addr = IPAddr._get_rpi_ip_address(intf)
+            ip_addr = IPAddr._get_rpi_ip_address(intf)
 
         return ip_addr
 
+    @staticmethod
+    def _get_ioctl_ip_address(netdev):
+        """Retrieve the IPv4 Address of the interface with the SIOCGIFADDR ioctl"""
+        ipaddr = None
+
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                ifreq = struct.pack("256s", netdev[:15].encode("utf-8"))
+                ipaddr = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFADDR, ifreq)[20:24])
+        except OSError:
+            # The interface doesn't exist or doesn't have an IPv4 Address
+            pass
+
+        return ipaddr
+
     @staticmethod
     def _get_rpi_ip_address(netdev='eth0'):
         """Retrieve the IP Address on Raspberry Pi"""
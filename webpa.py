@@ -0,0 +1,126 @@
+"""
+# File Name: webpa.py
+#
+# Description: Connection-Pooled WebPA Client
+#
+# Functionality:
+#  - A persistent requests.Session per (base url, credentials), so that connections (and their
+#    TCP+TLS handshakes) are reused across requests and across NucleusDevice instances
+#  - A tuned HTTPAdapter: connection pool size, keep-alive, retries with exponential backoff
+#    on 520 and 5xx responses and on connection errors
+#  - (connect, read) timeouts on every request
+#  - Requests that are part of a fan-out don't retry reads (a timed out read isn't sent again) and
+#    have a small total retry budget, so that they give up within their timeout
+#
+#   Class: WebPAClient(object)
+#    - __init__(base_url, creds, pool_size, retries, backoff_factor, timeout)
+#    - get_config(mac, names, timeout, stream, retry_reads)
+#    - close()
+#   Function: get_client(base_url, creds): the shared WebPAClient for the server
+#   Function: get_executor(): the shared thread pool used to issue WebPA requests concurrently
+#
+"""
+
+import logging
+import threading
+import concurrent.futures
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+WEBPA_POOL_SIZE = 64
+WEBPA_RETRIES = 3
+WEBPA_FAN_OUT_RETRIES = 1
+WEBPA_BACKOFF_FACTOR = 0.1
+WEBPA_RETRY_STATUSES = (500, 502, 503, 504, 520)
+WEBPA_CONNECT_TIMEOUT = 3.05
+WEBPA_READ_TIMEOUT = 30.0
+WEBPA_MAX_WORKERS = WEBPA_POOL_SIZE
+
+
+class WebPAClient:
+    """A WebPA Client that keeps a pool of persistent connections to the WebPA server"""
+    def __init__(self, base_url, creds, pool_size=WEBPA_POOL_SIZE, retries=WEBPA_RETRIES,
+                 backoff_factor=WEBPA_BACKOFF_FACTOR, timeout=(WEBPA_CONNECT_TIMEOUT, WEBPA_READ_TIMEOUT)):
+        """Initialize the WebPA Client"""
+        self._base_url = base_url
+        self._timeout = timeout
+
+        # raise_on_status=False: once the retries are used up, hand back the last response
+        #  so that the caller can still tell a 520 (device not reachable) from other errors
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+                      backoff_factor=backoff_factor, status_forcelist=WEBPA_RETRY_STATUSES,
+                      allowed_methods=frozenset(["GET"]), raise_on_status=False)
+        self._session = self._new_session(creds, pool_size, retry)
+
+        # read=False: a read that timed out is raised (requests.ReadTimeout) rather than sent again
+        fan_out_retry = Retry(total=min(retries, WEBPA_FAN_OUT_RETRIES), read=False,
+                              backoff_factor=backoff_factor, status_forcelist=WEBPA_RETRY_STATUSES,
+                              allowed_methods=frozenset(["GET"]), raise_on_status=False)
+        self._fan_out_session = self._new_session(creds, pool_size, fan_out_retry)
+
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    @staticmethod
+    def _new_session(creds, pool_size, retry):
+        """Build a Session with a pool of persistent connections and the retry policy"""
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry, pool_block=False)
+
+        session = requests.Session()
+        session.headers.update({"Authorization": "Basic " + str(creds), "Connection": "keep-alive"})
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def get_config(self, mac, names, timeout=None, stream=False, retry_reads=True):
+        """Retrieve the comma-separated parameter names from the device, returning the Response
+
+        timeout overrides the client's (connect, read) timeout for this request, with stream the body
+        is left to be read incrementally (see webpa_response.iter_response), without retry_reads a
+        read timeout raises requests.ReadTimeout and there's at most WEBPA_FAN_OUT_RETRIES retry
+        """
+        url = self._base_url + "mac:" + mac + "/config?names=" + names
+        session = self._session if retry_reads else self._fan_out_session
+        self._log.debug("get_config: Retrieving [%s] from [%s]", names, mac)
+        return session.get(url, timeout=self._timeout if timeout is None else timeout, stream=stream)
+
+    def close(self):
+        """Close the pooled connections"""
+        self._session.close()
+        self._fan_out_session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(base_url, creds):
+    """Retrieve the WebPAClient shared by every user of the WebPA server"""
+    key = (base_url, creds)
+    client = _clients.get(key)
+
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = WebPAClient(base_url, creds)
+                _clients[key] = client
+
+    return client
+
+
+_executor = None
+
+
+def get_executor():
+    """Retrieve the thread pool shared by everything that fans WebPA requests out concurrently"""
+    global _executor
+
+    if _executor is None:
+        with _clients_lock:
+            if _executor is None:
+                _executor = concurrent.futures.ThreadPoolExecutor(max_workers=WEBPA_MAX_WORKERS,
+                                                                  thread_name_prefix="WebPA")
+
+    return _executor
@@ -0,0 +1,278 @@
+"""
+# File Name: webpa_response.py
+#
+# Description: Streaming Parser and dataType Decoder for WebPA Responses
+#
+# Functionality:
+#  - Parses a WebPA response ({"parameters": [{"name", "value", "dataType", "parameterCount"}, ...]})
+#    incrementally from chunks of its body, so that peak memory doesn't depend on the response size
+#  - Yields a (name, value, dataType) triple for every parameter as soon as it has been received,
+#    whether it is a single parameter or an entry of a partial path's "value" list
+#  - Converts values to the Python type of their WebPA dataType (DATA_TYPE_DECODERS), either one
+#    at a time or a whole column of same-typed values at a time; values that don't convert are
+#    kept as the string WebPA returned
+#
+#   Function: iter_parameters(chunks): chunks of the body (bytes or str)
+#   Function: iter_response(response): a streamed requests.Response
+#   Function: decode_value(value, data_type)
+#   Function: decode_values(values, data_type): a column of values of the same dataType
+#   Function: decode_batch(parameters): (name, value, dataType) triples -> {name: typed value}
+#
+"""
+
+import json
+import base64
+import codecs
+import datetime
+
+
+WEBPA_CHUNK_SIZE = 64 * 1024
+
+# WebPA (WDMP) dataTypes
+DATA_TYPE_STRING = 0
+DATA_TYPE_INT = 1
+DATA_TYPE_UINT = 2
+DATA_TYPE_BOOLEAN = 3
+DATA_TYPE_DATETIME = 4
+DATA_TYPE_BASE64 = 5
+DATA_TYPE_LONG = 6
+DATA_TYPE_ULONG = 7
+DATA_TYPE_FLOAT = 8
+DATA_TYPE_DOUBLE = 9
+DATA_TYPE_BYTE = 10
+DATA_TYPE_NONE = 11
+
+_WHITESPACE = " \t\n\r"
+
+
+class _ChunkReader:
+    """Reads JSON tokens and values from a stream of chunks, keeping only the unread part buffered"""
+    def __init__(self, chunks):
+        """Initialize the _ChunkReader"""
+        self._chunks = iter(chunks)
+        self._utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._dropped = 0
+        self._eof = False
+
+    @property
+    def offset(self):
+        """Retrieve the offset (in characters) of the next unread character of the stream"""
+        return self._dropped + self._pos
+
+    def _fill(self):
+        """Append the next chunk to the buffer, return False at the end of the stream"""
+        if self._eof:
+            return False
+
+        # Drop what has already been read so that the buffer stays small
+        if self._pos:
+            self._buf = self._buf[self._pos:]
+            self._dropped += self._pos
+            self._pos = 0
+
+        for chunk in self._chunks:
+            if isinstance(chunk, bytes):
+                chunk = self._utf8_decoder.decode(chunk)
+            if chunk:
+                self._buf += chunk
+                return True
+
+        self._buf += self._utf8_decoder.decode(b"", final=True)
+        self._eof = True
+        return False
+
+    def peek(self):
+        """Retrieve the next non-whitespace character without consuming it, or "" at the end"""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, chars):
+        """Consume the next non-whitespace character, which has to be one of chars"""
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError("Expected one of [{}] in the WebPA response, found [{}]".format(chars, char))
+        self._pos += 1
+        return char
+
+    def value(self):
+        """Consume and decode the next complete JSON value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if self._fill():
+                    continue
+                raise
+
+            # A number at the end of the buffer might continue in the next chunk
+            if end == len(self._buf) and self._fill():
+                continue
+
+            self._pos = end
+            return value
+
+
+def iter_parameters(chunks):
+    """Yield the (name, value, dataType) of every parameter in the WebPA response body"""
+    reader = _ChunkReader(chunks)
+
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+
+    while True:
+        key = reader.value()
+        reader.expect(":")
+
+        if key == "parameters" and reader.peek() == "[":
+            reader.expect("[")
+            if reader.peek() != "]":
+                while True:
+                    yield from _iter_parameter(reader)
+                    if reader.expect(",]") == "]":
+                        break
+            else:
+                reader.expect("]")
+        else:
+            reader.value()
+
+        if reader.expect(",}") == "}":
+            break
+
+
+def _iter_parameter(reader):
+    """Yield the parameters of a single entry of the "parameters" list"""
+    parameter = {}
+
+    reader.expect("{")
+    if reader.peek() == "}":
+        reader.expect("}")
+        return
+
+    while True:
+        key = reader.value()
+        reader.expect(":")
+
+        if key == "value" and reader.peek() == "[":
+            # A partial path: stream its entries one at a time
+            reader.expect("[")
+            if reader.peek() != "]":
+                while True:
+                    reader.peek()
+                    entry_offset = reader.offset
+                    entry = reader.value()
+                    if not isinstance(entry, dict) or "name" not in entry or "value" not in entry:
+                        raise ValueError("Malformed parameter at offset {} of the WebPA response: {}".format(
+                            entry_offset, json.dumps(entry)[:200]))
+                    yield entry["name"], entry["value"], entry.get("dataType")
+                    if reader.expect(",]") == "]":
+                        break
+            else:
+                reader.expect("]")
+            parameter["value"] = None
+        else:
+            parameter[key] = reader.value()
+
+        if reader.expect(",}") == "}":
+            break
+
+    if parameter.get("value") is not None and "name" in parameter:
+        yield parameter["name"], parameter["value"], parameter.get("dataType")
+
+
+def iter_response(response, chunk_size=WEBPA_CHUNK_SIZE):
+    """Yield the (name, value, dataType) of every parameter in a streamed requests.Response"""
+    return iter_parameters(response.iter_content(chunk_size=chunk_size))
+
+
+def _decode_boolean(value):
+    """Convert a WebPA boolean ("true"/"false"/"1"/"0")"""
+    lowered = str(value).lower()
+    if lowered in ("true", "1"):
+        return True
+    if lowered in ("false", "0"):
+        return False
+    raise ValueError("Invalid boolean [{}]".format(value))
+
+
+def _decode_datetime(value):
+    """Convert a WebPA dateTime (ISO 8601, usually UTC with a "Z" suffix)"""
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    return datetime.datetime.fromisoformat(value)
+
+
+def _decode_base64(value):
+    """Convert a WebPA base64 value to bytes"""
+    return base64.b64decode(value, validate=True)
+
+
+# dataType -> conversion from the WebPA string, dataTypes without an entry are kept as strings
+DATA_TYPE_DECODERS = {
+    DATA_TYPE_INT: int,
+    DATA_TYPE_UINT: int,
+    DATA_TYPE_BOOLEAN: _decode_boolean,
+    DATA_TYPE_DATETIME: _decode_datetime,
+    DATA_TYPE_BASE64: _decode_base64,
+    DATA_TYPE_LONG: int,
+    DATA_TYPE_ULONG: int,
+    DATA_TYPE_FLOAT: float,
+    DATA_TYPE_DOUBLE: float,
+    DATA_TYPE_BYTE: int,
+}
+
+
+def decode_value(value, data_type):
+    """Convert the value of a WebPA parameter to the Python type of its dataType"""
+    decoder = DATA_TYPE_DECODERS.get(data_type)
+    if decoder is None:
+        return value
+
+    try:
+        return decoder(value)
+    except (ValueError, TypeError):
+        return value
+
+
+def decode_values(values, data_type):
+    """Convert a column of values that share a dataType, returning a list"""
+    decoder = DATA_TYPE_DECODERS.get(data_type)
+    if decoder is None:
+        return list(values)
+
+    try:
+        return list(map(decoder, values))
+    except (ValueError, TypeError):
+        # At least one value doesn't convert, fall back to converting them one at a time
+        return [decode_value(value, data_type) for value in values]
+
+
+def decode_batch(parameters):
+    """Convert (name, value, dataType) triples into {name: typed value}, one dataType column at a time"""
+    result = {}
+    columns = {}
+
+    for name, value, data_type in parameters:
+        result[name] = value
+        column = columns.get(data_type)
+        if column is None:
+            column = ([], [])
+            columns[data_type] = column
+        column[0].append(name)
+        column[1].append(value)
+
+    for data_type, (names, values) in columns.items():
+        if data_type in DATA_TYPE_DECODERS:
+            for name, typed_value in zip(names, decode_values(values, data_type)):
+                result[name] = typed_value
+
+    return result